@@ -1,43 +1,60 @@
 import eventlet
 
 eventlet.monkey_patch()
+from eventlet import tpool
+from eventlet.queue import Queue
+import gzip
+import hashlib
 import json
 import os
+import pickle
 import sys
-from datetime import datetime
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
 from pprint import pprint
-from typing import Dict, List, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Response, jsonify, render_template, request
 from flask_socketio import SocketIO, emit
 from slippi import id
 
 import database
 import settings
+from utils import elo, metrics, players, stats
 from utils.files import (
-    detect_new_files,
+    date_from_replay_name,
+    facts_to_row,
     find_replay_directory,
-    is_file_locked,
+    new_files,
     parse_replay,
 )
+from utils.matchups import MatchupAggregator, empty_chart
+from utils.players import PlayerRatings
+from utils.slp import ReplayTail
+from utils.watcher import create_watcher
 
 app = Flask(__name__)
 app.json.sort_keys = False
 socketio = SocketIO(app)
 
 
-games_df = pd.DataFrame(columns=database.columns)
-games_df = games_df.set_index("datetime")
-games_df = pd.read_pickle("db.pkl")
-games_df = games_df.sort_index()
-print(games_df)
-print(games_df.columns)
-print(games_df.dtypes)
+# The game store, replay index, quarantine and checkpoints are loaded on
+# first use, see wait_for_games. Until then the saved state is served.
+games_df = database.to_frame([])
+# Id of the stored games, changed when recalculate_db.py replaces them.
+store_generation = None
+replay_index = None
+quarantine = None
+replay_cache = database.ReplayCache()
+games_loading = None
 
 player_ports = settings.DEFAULT_PLAYER_PORTS
-date_range = {"start": datetime(1, 1, 1, 0, 0, 0), "end": datetime.now()}
+# Open ended when None, otherwise a date or datetime string.
+date_range = {"start": None, "end": None}
 
 last_results = [None] * 10
 
@@ -45,7 +62,52 @@ character_ratings = {}
 
 ignored_games = set()
 
-matchup_chart = [[{"win_rate": "nan", "matches": 0}] * 26 for _ in range(26)]
+matchup_chart = empty_chart()
+
+matchup_aggregator = MatchupAggregator()
+
+# Character pairs shown in the matchup chart.
+matchup_pairs = set()
+
+last_winner = None
+
+# Ratings of every player, not only the P1/P2 pair of the tier list.
+player_ratings = PlayerRatings()
+
+# Rating state snapshots every CHECKPOINT_INTERVAL games of the full history.
+checkpoints = []
+
+# State saved by the last run, valid if its games are still the same.
+saved_state = None
+
+# Recalculated state per date range, cleared whenever games are added.
+range_cache = OrderedDict()
+
+# Results of /stats per filter combination, cleared along with range_cache.
+stats_cache = OrderedDict()
+
+# Every change to the state above bumps the version. Single game changes are
+# kept as deltas so clients that fell behind can catch up without a snapshot.
+state_version = 0
+state_deltas = deque(maxlen=settings.DELTA_HISTORY)
+
+# Encoded responses for the current state version, see cached_response.
+response_cache = {}
+
+# Held while the state is changed by more than one step, replays yield to
+# the hub between chunks and must not interleave with each other.
+state_lock = threading.RLock()
+
+# Replays still being written, followed to show the game in progress.
+live_tails = {}
+
+# Games stored from the tail of their replay, until the finished file is parsed.
+live_games = {}
+
+# New replays pass from the watcher through parsing, storing and broadcasting.
+parse_queue = Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+store_queue = Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+broadcast_queue = Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
 
 
 ### TODO:
@@ -68,8 +130,22 @@ def matchup_charts():
 
 @app.route("/matchups", methods=["GET"])
 def matchups():
-    global matchup_chart
-    return jsonify(matchup_chart)
+    return cached_response("matchups")
+
+
+@app.route("/tier_list", methods=["GET"])
+def get_tier_list():
+    return cached_response("tier_list")
+
+
+@app.route("/results", methods=["GET"])
+def get_results():
+    return cached_response("results")
+
+
+@app.route("/state", methods=["GET"])
+def get_state():
+    return cached_response("state")
 
 
 @app.route("/reset", methods=["POST"])
@@ -78,6 +154,8 @@ def reset_tier_list():
     with open(settings.TIER_FILE_BASE, "r") as file:
         character_ratings = json.load(file)
 
+    bump_state()
+    emit_all()
     return jsonify(character_ratings)
 
 
@@ -86,7 +164,8 @@ def recalculate_tier_list():
     global character_ratings
     reload_tier_list()
 
-    socketio.emit("results_update", last_results)
+    bump_state()
+    emit_all()
     with app.app_context():
         return jsonify(character_ratings)
 
@@ -132,29 +211,224 @@ def get_date_range():
 def set_date_range():
     global date_range
     data = request.json
-    start = data.get("start")
-    end = data.get("end")
-
-    if not start or not end:
+    if "start" not in data or "end" not in data:
         return jsonify({"error": "Missing values"}), 400
 
+    start = data.get("start") or None
+    end = data.get("end") or None
+    try:
+        database.to_timestamp(start)
+        database.to_timestamp(end, end=True)
+    except ValueError:
+        return jsonify({"error": "Invalid date"}), 400
+
     date_range["start"] = start
     date_range["end"] = end
 
+    reload_tier_list()
+    bump_state()
+    emit_all()
+
     return jsonify({"message": f"Date range set to {date_range}"})
 
 
+@app.route("/ignore", methods=["POST"])
+def set_ignored():
+    global games_df
+    data = request.json
+    try:
+        date = pd.to_datetime(data.get("datetime"), utc=True)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid date"}), 400
+
+    wait_for_games()
+
+    if date not in games_df.index:
+        return jsonify({"error": "Game not found"}), 404
+
+    ignore = bool(data.get("ignore", True))
+    # The games can't change under a replay in progress.
+    with state_lock:
+        games_df.loc[date, "ignore"] = ignore
+        database.save_games(games_df)
+
+        range_cache.clear()
+        stats_cache.clear()
+        invalidate_checkpoints(date)
+        reload_tier_list()
+        bump_state()
+    emit_all()
+
+    return jsonify({"message": f"Game at {date} ignore set to {ignore}"})
+
+
+@app.route("/players", methods=["GET"])
+def get_players():
+    return jsonify(player_ratings.players())
+
+
+@app.route("/players/<code>", methods=["GET"])
+def get_player(code: str):
+    ratings = player_ratings.ratings(code)
+    if ratings is None:
+        return jsonify({"error": "Player not found"}), 404
+    return jsonify(
+        {
+            id.CSSCharacter(character).name: rating
+            for character, rating in enumerate(ratings)
+        }
+    )
+
+
+@app.route("/players/<code>/matchups/<opponent>", methods=["GET"])
+def get_player_matchups(code: str, opponent: str):
+    chart = player_ratings.matchups(code, opponent)
+    if chart is None:
+        return jsonify({"error": "Player not found"}), 404
+    return jsonify(chart)
+
+
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    args = request.args
+    player = args.get("player", "P1")
+    if player not in elo.PLAYERS:
+        return jsonify({"error": "Invalid player"}), 400
+    try:
+        start = database.to_timestamp(args.get("start"))
+        end = database.to_timestamp(args.get("end"), end=True)
+    except ValueError:
+        return jsonify({"error": "Invalid date"}), 400
+    try:
+        character, opponent = (
+            id.CSSCharacter[args[name]].value if args.get(name) else None
+            for name in ("character", "opponent")
+        )
+        stage = id.Stage[args["stage"]].value if args.get("stage") else None
+    except KeyError as e:
+        return jsonify({"error": f"Unknown character or stage {e}"}), 400
+
+    wait_for_games()
+    key = (player, start, end, character, opponent, stage, eligibility())
+    if key in stats_cache:
+        stats_cache.move_to_end(key)
+        return jsonify(stats_cache[key])
+
+    with metrics.span("stats"):
+        games = elo.eligible_games(
+            database.select_range(games_df, start, end), stats.COLUMNS
+        )
+        games = games[players.legacy_mask(games)]
+        games = stats.filter_games(games, player, character, opponent, stage)
+        result = stats.game_stats(games, player)
+
+    stats_cache[key] = result
+    while len(stats_cache) > settings.STATS_CACHE_SIZE:
+        stats_cache.popitem(last=False)
+    return jsonify(result)
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    for name, queue in (
+        ("parse", parse_queue),
+        ("store", store_queue),
+        ("broadcast", broadcast_queue),
+    ):
+        metrics.set_gauge("queue_size", queue.qsize(), queue=name)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @socketio.on("connect")
-def emit_all():
-    socketio.emit("tier_update", character_ratings)
-    socketio.emit("results_update", last_results)
+def send_state():
+    # Clients load the state itself from the cached /state response.
+    socketio.emit("state_version", state_version, to=request.sid)
+
+
+@socketio.on("request_snapshot")
+def send_snapshot(data):
+    since = data.get("since") if isinstance(data, dict) else None
+    if since == state_version:
+        return
+
+    missed = [delta for delta in state_deltas if delta["version"] > (since or 0)]
+    if isinstance(since, int) and missed and missed[0]["version"] == since + 1:
+        for delta in missed:
+            socketio.emit("state_delta", delta, to=request.sid)
+    else:
+        # Wait out a replay in progress rather than send half of it.
+        with state_lock:
+            emit_all(to=request.sid)
+
+
+def emit_all(to: Optional[str] = None):
+    socketio.emit("tier_update", character_ratings, to=to)
+    socketio.emit("results_update", last_results, to=to)
     socketio.emit(
         "matchup_update",
-        {
-            "matchups": matchup_chart,
-            "winner": "P1" if games_df.tail(1).squeeze()["p1_won"] else "P2",
-        },
+        {"matchups": matchup_chart, "winner": last_winner},
+        to=to,
     )
+    socketio.emit("state_version", state_version, to=to)
+
+
+def state_payload(name: str) -> Any:
+    if name == "tier_list":
+        return character_ratings
+    if name == "results":
+        return last_results
+    if name == "matchups":
+        return matchup_chart
+    return {
+        "version": state_version,
+        "tiers": character_ratings,
+        "results": last_results,
+        "matchups": matchup_chart,
+        "winner": last_winner,
+    }
+
+
+def cached_state(name: str) -> Dict:
+    """Encoded part of the state, once per state version."""
+    entry = response_cache.get(name)
+    if entry is None or entry["version"] != state_version:
+        body = app.json.dumps(state_payload(name)).encode()
+        entry = response_cache[name] = {
+            "version": state_version,
+            "body": body,
+            "gzip": gzip.compress(body),
+            # Hash of the content, versions restart from zero with the app.
+            "etag": hashlib.blake2b(body, digest_size=8).hexdigest(),
+        }
+    return entry
+
+
+def cached_response(name: str) -> Response:
+    """JSON response for a part of the state, encoded once per state version."""
+    entry = cached_state(name)
+    response = Response(mimetype="application/json")
+    if "gzip" in request.accept_encodings:
+        response.set_data(entry["gzip"])
+        response.headers["Content-Encoding"] = "gzip"
+        response.set_etag(f"{entry['etag']}-gzip")
+    else:
+        response.set_data(entry["body"])
+        response.set_etag(entry["etag"])
+    response.vary.add("Accept-Encoding")
+    # Browsers revalidate with If-None-Match on every request.
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def bump_state(delta: Optional[Dict] = None) -> None:
+    global state_version
+    state_version += 1
+    if delta is None:
+        # Deltas from before a full state change can't be applied on top of it.
+        state_deltas.clear()
+    else:
+        delta["version"] = state_version
+        state_deltas.append(delta)
 
 
 ### Logic
@@ -174,21 +448,17 @@ def update_tiers(
     p1_char["matches"] += 1
     p2_char["matches"] += 1
 
-    E_p = lambda R_a, R_b: 1.0 / (1.0 + pow(10, ((R_b - R_a) / 400)))
-    R_n = lambda R, K, S, E: R + K * (S - E)
-    K = lambda m: max(800 / m, 50)
-
-    p1_char["elo"] = R_n(
+    p1_char["elo"] = elo.new_rating(
         p1_rating,
-        K(p1_char["matches"]),
+        elo.k_factor(p1_char["matches"]),
         int(p1["won"]),
-        E_p(p1_rating, p2_rating),
+        elo.expected_score(p1_rating, p2_rating),
     )
-    p2_char["elo"] = R_n(
+    p2_char["elo"] = elo.new_rating(
         p2_rating,
-        K(p2_char["matches"]),
+        elo.k_factor(p2_char["matches"]),
         int(p2["won"]),
-        E_p(p2_rating, p1_rating),
+        elo.expected_score(p2_rating, p1_rating),
     )
 
     last_results.append(
@@ -241,7 +511,7 @@ def update_tiers(
 
 def process_game(
     data: Dict[str, Union[int, str]], debug_print: bool = False, weighted: bool = True
-) -> None:
+) -> Optional[Tuple[int, int]]:
     global player_ports
     if not data or data["ignore"]:
         return
@@ -271,81 +541,649 @@ def process_game(
     update_tiers(P1, P2)
     update_matchups(P1, P2, weighted)
 
+    return P1["character"], P2["character"]
+
 
 def update_matchups(P1, P2, weighted: bool = True):
     # Matchup chart is stored from the perspective of P1.
     global matchup_chart
 
-    subset = games_df[
-        (games_df["p1_character"] == P1["character"])
-        & (games_df["p2_character"] == P2["character"])
-        & (games_df["p1_code"] == settings.PLAYER_CODES["P1"])
-        & (games_df["end_type"] != 7)
-    ]
+    matchup_chart[P1["character"]][P2["character"]] = matchup_aggregator.result(
+        P1["character"], P2["character"], weighted
+    )
+    matchup_pairs.add((int(P1["character"]), int(P2["character"])))
 
-    winrate = "nan"
-    matches = len(subset)
 
-    if not weighted:
-        subset = subset[-100:]
-        winrate1 = subset["p1_won"].mean()
-        matches = len(subset)
-        if not np.isnan(winrate1):
-            winrate = winrate1
-    else:
-        # weight_func = lambda x: 1.1 ** (1 - x)
-        weight_func = lambda x: np.e ** (-0.1 * (x - 1))
-        subset = subset[-100:]
-        matches = len(subset)
+def parse_new_replay(
+    path: str, timings: Optional[Dict[str, float]] = None
+) -> Optional[Tuple[str, os.stat_result, Dict]]:
+    wait_for_games()
+    stat = os.stat(path)
+    if not replay_index.is_new(path, stat) or not quarantine.should_retry(path, stat):
+        return None
+
+    metrics.increment("replays_total")
+    with metrics.span("parse", timings):
+        try:
+            # Parsed in an OS thread so the event loop keeps serving clients.
+            data = tpool.execute(
+                parse_replay, path, player_ports, True, cache=replay_cache
+            )
+        except Exception:
+            # Left out of the replay index, so it's tried again once it changes.
+            reason = traceback.format_exc()
+            print(f"Failed to parse {path}, quarantined:\n{reason}")
+            metrics.increment("replay_parse_failures_total")
+            quarantine.add(path, stat, reason)
+            return None
+    quarantine.discard(path)
+    if data["ignore"]:
+        metrics.increment("games_ignored_total", reason="parser")
+
+    return path, stat, data
+
+
+def parse_new_replays(
+    paths: List[str], timings: Optional[Dict[str, float]] = None
+) -> List[Tuple[str, os.stat_result, Dict]]:
+    def parse(path):
+        try:
+            return parse_new_replay(path, timings)
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    pool = eventlet.GreenPool(settings.PARSE_THREADS)
+    parsed = [parsed for parsed in pool.imap(parse, paths) if parsed]
+    # Saved once per batch rather than by each of the parallel parses.
+    if quarantine is not None and quarantine.changed:
+        try:
+            tpool.execute(quarantine.save)
+        except OSError:
+            traceback.print_exc()
+    return parsed
+
+
+def store_replays(
+    parsed: List[Tuple[str, os.stat_result, Dict]],
+    timings: Optional[Dict[str, float]] = None,
+) -> Optional[Dict]:
+    """Add parsed replays to the games and ratings in chronological order.
+
+    Returns one delta covering all of them, a snapshot marker if the ratings
+    had to be recalculated, or None if nothing in the selected range changed.
+    """
+    global games_df, last_winner
+    wait_for_games()
+    # Games read from the tail of a replay in progress come without a stat.
+    # They are replaced if the finished replay disagrees with them, or only
+    # filled in if it just adds the frame stats.
+    finished = {path for path, stat, _ in parsed if stat is not None}
+    parsed = [game for game in parsed if game[1] is not None or game[0] not in finished]
+    stale = []
+    filled = []
+    for path, stat, data in parsed:
+        if stat is None:
+            live_games[path] = data
+            continue
+        live = live_games.pop(path, None)
+        if live is None:
+            continue
+        if not same_game(live, data):
+            stale.append(pd.to_datetime(live["datetime"]))
+        elif data["last_stock"] is not None:
+            filled.append(data)
+    if stale:
+        games_df = games_df.drop(
+            index=[date for date in stale if date in games_df.index]
+        )
+    if filled:
+        filled_df = database.to_frame(filled)
+        filled_df = filled_df[filled_df.index.isin(games_df.index)]
+        games_df = database.concat(
+            [games_df.drop(index=filled_df.index), filled_df]
+        ).sort_index(kind="stable")
+
+    games = {}
+    for _, _, data in parsed:
+        date = pd.to_datetime(data["datetime"])
+        if date not in games_df.index:
+            games.setdefault(date, data)
+    games = sorted(games.items(), key=lambda game: game[0])
+
+    late = bool(stale)
+    if games:
+        new_games = database.to_frame([data for _, data in games])
+        late = late or bool(len(games_df) and games[0][0] < games_df.index[-1])
+        with metrics.span("append", timings):
+            games_df = database.concat([games_df, new_games])
+            range_cache.clear()
+            stats_cache.clear()
+            if late:
+                # Elo depends on game order, replay from the last checkpoint before it.
+                games_df = games_df.sort_index(kind="stable")
+                invalidate_checkpoints(min(stale + [games[0][0]]))
+        with metrics.span("persist", timings):
+            if stale or filled:
+                tpool.execute(database.save_games, games_df)
+            else:
+                tpool.execute(database.append_games, new_games)
+    elif stale or filled:
+        if stale:
+            invalidate_checkpoints(min(stale))
+        with metrics.span("persist", timings):
+            tpool.execute(database.save_games, games_df)
+    with metrics.span("index", timings):
+        replay_index.update(
+            (path, stat) for path, stat, _ in parsed if stat is not None
+        )
 
-        if not subset.empty:
-            weights = np.array([weight_func(i) for i in reversed(range(len(subset)))])
-            winrate1 = (subset["p1_won"] * weights).sum() / weights.sum()
+    if stale:
+        range_cache.clear()
+        stats_cache.clear()
+        with metrics.span("reload", timings):
+            reload_tier_list()
+        return {"snapshot": True}
 
-            if not np.isnan(winrate1):
-                winrate = winrate1
+    games = [(date, data) for date, data in games if in_selected_range(date)]
+    if not games:
+        return None
+    if late:
+        with metrics.span("reload", timings):
+            reload_tier_list()
+        return {"snapshot": True}
+
+    with metrics.span("players", timings):
+        player_ratings.add_games(
+            elo.eligible_games(database.to_frame([data for _, data in games]))
+        )
 
-    matchup_chart[P1["character"]][P2["character"]] = {
-        "win_rate": winrate,
-        "matches": matches,
+    tiers = {}
+    matchups = {}
+    rated = 0
+    with metrics.span("process_game", timings):
+        for _, data in games:
+            if not players.is_legacy_game(data):
+                continue
+            matchup_aggregator.add_game(data)
+            last_winner = "P1" if data["p1_won"] else "P2"
+
+            characters = process_game(data, True, False)
+            if not characters:
+                if not data["ignore"]:
+                    metrics.increment("games_ignored_total", reason="rules")
+                continue
+
+            rated += 1
+            p1_character, p2_character = characters
+            tiers[("P1", p1_character)] = character_ratings["P1"][p1_character]
+            tiers[("P2", p2_character)] = character_ratings["P2"][p2_character]
+            matchups[(p1_character, p2_character)] = matchup_chart[p1_character][
+                p2_character
+            ]
+
+    return {
+        "tiers": [
+            {"player": player, "character": character} | rating
+            for (player, character), rating in tiers.items()
+        ],
+        "results": last_results[len(last_results) - min(rated, len(last_results)) :],
+        "matchups": [
+            {"p1": p1_character, "p2": p2_character} | cell
+            for (p1_character, p2_character), cell in matchups.items()
+        ],
+        "winner": last_winner,
     }
 
 
-def process_new_replay(path: str):
-    global games_df
-    data = parse_replay(path, player_ports, True)
-    date = pd.to_datetime(data["datetime"])
-    if date not in games_df.index:
-        games_df.loc[date] = data
-        games_df.to_pickle("db.pkl")
-    process_game(data, True, False)
+def same_game(a: Dict, b: Dict) -> bool:
+    """Whether two rows of a game rate it the same, frame stats aside."""
+    games = database.to_frame([a, b]).drop(columns=database.frame_stat_columns)
+    return games.index[0] == games.index[1] and games.iloc[0].equals(games.iloc[1])
 
 
-def reload_tier_list():
-    global character_ratings, matchup_chart
+def live_game(data: Dict) -> Dict:
+    return {
+        "stage": data["stage"],
+        "P1": {
+            "character": id.CSSCharacter(data["p1_character"]).name,
+            "stocks": data["p1_stocks"],
+        },
+        "P2": {
+            "character": id.CSSCharacter(data["p2_character"]).name,
+            "stocks": data["p2_stocks"],
+        },
+    }
+
+
+def follow_live_games(paths: List[str]) -> None:
+    """Read what was written to replays in progress since the last call.
+
+    Publishes the stocks as they change and stores the game as soon as its
+    end is written, without waiting for Slippi to finish the file. The
+    replay is parsed again once it is finished, see store_replays.
+    """
+    for path in paths:
+        if path not in live_tails:
+            try:
+                date = date_from_replay_name(os.path.basename(path))
+            except AttributeError:
+                # Without a date in the name there's nothing to store it by.
+                continue
+            live_tails[path] = ReplayTail(path, date)
+
+    for path, tail in list(live_tails.items()):
+        if path not in paths or tail.failed:
+            # Finished or gone before its end could be read, left to the parse.
+            del live_tails[path]
+            if tail.started:
+                socketio.emit("game_in_progress", None)
+            continue
+
+        try:
+            with metrics.span("tail"):
+                if not tail.read():
+                    continue
+            data = facts_to_row(tail.facts(), player_ports)
+        except Exception:
+            traceback.print_exc()
+            tail.failed = True
+            continue
+
+        if not tail.ended:
+            # Games that won't be rated aren't shown either.
+            if not data["ignore"]:
+                socketio.emit("game_in_progress", live_game(data))
+            continue
+
+        del live_tails[path]
+        socketio.emit("game_in_progress", None)
+        if not data["ignore"]:
+            print(f"\nGame in {path} ended.")
+            store_queue.put(([(path, None, data)], {}, time.perf_counter()))
+
+
+def process_new_replay(
+    path: str, timings: Optional[Dict[str, float]] = None
+) -> Optional[Dict]:
+    parsed = parse_new_replay(path, timings)
+    return store_replays([parsed], timings) if parsed else None
+
+
+def selected_range() -> Tuple[Optional[pd.Timestamp], Optional[pd.Timestamp]]:
+    return (
+        database.to_timestamp(date_range["start"]),
+        database.to_timestamp(date_range["end"], end=True),
+    )
+
+
+def in_selected_range(date: pd.Timestamp) -> bool:
+    start, end = selected_range()
+    return (start is None or date >= start) and (end is None or date < end)
+
+
+def eligibility() -> Tuple:
+    # Settings that change which games are rated or how, and so invalidate results.
+    with open(settings.TIER_FILE_BASE, "rb") as file:
+        base_ratings = hashlib.blake2b(file.read(), digest_size=8).hexdigest()
+    return (
+        settings.ALLOW_EXIT,
+        settings.MIN_GAME_DURATION_SECONDS,
+        settings.ELO_K_NUMERATOR,
+        settings.ELO_K_MIN,
+        settings.ELO_SCALE,
+        settings.MATCHUP_DECAY,
+        settings.MATCHUP_WINDOW,
+        tuple(sorted(settings.PLAYER_CODES.items())),
+        settings.RATE_ALL_PLAYERS,
+        base_ratings,
+    )
+
+
+def reset_state() -> None:
+    global character_ratings, last_results, last_winner, matchup_pairs
+    global player_ratings
     with open(settings.TIER_FILE_BASE, "r") as file:
         character_ratings = json.load(file)
 
-    matchup_chart = [[{"win_rate": "nan", "matches": 0}] * 26 for _ in range(26)]
+    last_results = [None] * 10
+    last_winner = None
+    matchup_aggregator.reset()
+    matchup_pairs = set()
+    player_ratings = PlayerRatings()
+
+
+def save_checkpoint(position: int) -> None:
+    checkpoints.append(
+        {
+            "position": position,
+            "version": database.CHECKPOINT_VERSION,
+            "until": games_df.index[position - 1],
+            "generation": store_generation,
+            "eligibility": eligibility(),
+            # Pickling is much faster than copy.deepcopy for the aggregator.
+            "state": pickle.dumps(
+                (
+                    character_ratings,
+                    last_results,
+                    last_winner,
+                    matchup_aggregator,
+                    matchup_pairs,
+                    player_ratings,
+                )
+            ),
+        }
+    )
+
+
+def restore_checkpoint() -> int:
+    """Restore the latest checkpoint still matching games_df.
 
-    # TODO: use games_df["ignored" == False]
-    for row in games_df.to_dict(orient="records"):
-        process_game(row, False, False)
+    Returns the number of games it covers, 0 if starting from the base.
+    """
+    global character_ratings, last_results, last_winner, matchup_aggregator
+    global matchup_pairs, player_ratings, checkpoints
+
+    checkpoints = [
+        checkpoint
+        for checkpoint in checkpoints
+        if checkpoint.get("version") == database.CHECKPOINT_VERSION
+        and checkpoint.get("generation") == store_generation
+        and checkpoint["eligibility"] == eligibility()
+        and checkpoint["position"] <= len(games_df)
+        and games_df.index[checkpoint["position"] - 1] == checkpoint["until"]
+    ]
+    if not checkpoints:
+        reset_state()
+        return 0
+
+    (
+        character_ratings,
+        last_results,
+        last_winner,
+        matchup_aggregator,
+        matchup_pairs,
+        player_ratings,
+    ) = pickle.loads(checkpoints[-1]["state"])
+    return checkpoints[-1]["position"]
+
+
+def invalidate_checkpoints(date: pd.Timestamp) -> None:
+    global checkpoints
+    checkpoints = [
+        checkpoint for checkpoint in checkpoints if checkpoint["until"] < date
+    ]
+    database.save_checkpoints(checkpoints)
+
+
+def replay_games(range_df: pd.DataFrame, offset: int = 0, checkpoint: bool = False):
+    global last_results, last_winner
+
+    interval = settings.CHECKPOINT_INTERVAL
+    position = 0
+    while position < len(range_df):
+        # Chunks end on multiples of the interval so checkpoints line up.
+        stop = min(
+            len(range_df), ((offset + position) // interval + 1) * interval - offset
+        )
+        chunk = range_df.iloc[position:stop]
+
+        # The chart covers every game, not just the ones replayed so far.
+        matchup_aggregator.add_games(chunk)
+
+        games = elo.eligible_games(chunk)
+        player_ratings.add_games(games)
+
+        # The tier list only rates the P1/P2 pair.
+        legacy = players.legacy_mask(chunk)
+        games = games[players.legacy_mask(games)]
+        p1_characters = games["p1_character"].to_numpy()
+        p2_characters = games["p2_character"].to_numpy()
+        p1_deltas, p2_deltas = elo.replay_ratings(
+            character_ratings,
+            p1_characters,
+            p2_characters,
+            games["p1_won"].to_numpy(),
+            games["p2_won"].to_numpy(),
+        )
+
+        recent = range(max(len(games) - len(last_results), 0), len(games))
+        last_results = (
+            last_results
+            + [
+                {
+                    "P1": {
+                        "character": id.CSSCharacter(p1_characters[i]).name,
+                        "delta": float(p1_deltas[i]),
+                    },
+                    "P2": {
+                        "character": id.CSSCharacter(p2_characters[i]).name,
+                        "delta": float(p2_deltas[i]),
+                    },
+                }
+                for i in recent
+            ]
+        )[-len(last_results) :]
+
+        matchup_pairs.update(zip(p1_characters.tolist(), p2_characters.tolist()))
+        if legacy.any():
+            last_won = chunk["p1_won"].iloc[np.flatnonzero(legacy)[-1]]
+            last_winner = "P1" if not pd.isna(last_won) and last_won else "P2"
+
+        position = stop
+        if checkpoint and (offset + position) % interval == 0:
+            save_checkpoint(offset + position)
+        # Let the hub serve clients between chunks.
+        eventlet.sleep(0)
 
-    print("Tier list recalculation done.")
+
+def reload_tier_list():
+    global character_ratings, last_results, last_winner, matchup_chart
+    global matchup_aggregator, matchup_pairs, player_ratings
+    with state_lock:
+        wait_for_games()
+        start, end = selected_range()
+        key = (start, end, eligibility())
+        if key in range_cache:
+            range_cache.move_to_end(key)
+            restore_state(range_cache[key])
+            save_state()
+            print("Tier list loaded from cache.")
+            return
+
+        # Clients get the state from before the replay until it's done.
+        for name in ("state", "tier_list", "results", "matchups"):
+            cached_state(name)
+
+        if start is None and end is None:
+            # Continue from the latest checkpoint instead of the base ratings.
+            position = restore_checkpoint()
+            count = len(checkpoints)
+            replay_games(games_df.iloc[position:], position, checkpoint=True)
+            if len(checkpoints) != count:
+                database.save_checkpoints(checkpoints)
+        else:
+            reset_state()
+            replay_games(database.select_range(games_df, start, end))
+
+        matchup_chart = matchup_aggregator.chart(matchup_pairs, False)
+
+        range_cache[key] = dump_state()
+        while len(range_cache) > settings.RANGE_CACHE_SIZE:
+            range_cache.popitem(last=False)
+        save_state()
+
+        print("Tier list recalculation done.")
+
+
+def dump_state() -> bytes:
+    return pickle.dumps(
+        (
+            character_ratings,
+            last_results,
+            matchup_chart,
+            matchup_aggregator,
+            matchup_pairs,
+            last_winner,
+            player_ratings,
+        )
+    )
+
+
+def restore_state(state: bytes) -> None:
+    global character_ratings, last_results, matchup_chart, matchup_aggregator
+    global matchup_pairs, last_winner, player_ratings
+    (
+        character_ratings,
+        last_results,
+        matchup_chart,
+        matchup_aggregator,
+        matchup_pairs,
+        last_winner,
+        player_ratings,
+    ) = pickle.loads(state)
+
+
+def save_state() -> None:
+    """Save the all time state for the next start to serve right away."""
+    if selected_range() != (None, None):
+        return
+    state = {
+        "version": database.CHECKPOINT_VERSION,
+        "eligibility": eligibility(),
+        "games": database.games_fingerprint(games_df, store_generation),
+        "state": dump_state(),
+    }
+    tpool.execute(database.save_state, state)
+
+
+def restore_saved_state() -> None:
+    global saved_state
+    saved_state = database.load_state()
+    if (
+        saved_state is not None
+        and saved_state.get("version") == database.CHECKPOINT_VERSION
+        and saved_state["eligibility"] == eligibility()
+    ):
+        restore_state(saved_state["state"])
+    else:
+        saved_state = None
+        reset_state()
+
+
+def load_games() -> None:
+    global games_df, store_generation, replay_index, quarantine, checkpoints
+    start = time.perf_counter()
+    # Read in OS threads so the event loop keeps serving the saved state.
+    store_generation = tpool.execute(database.load_generation)
+    games_df = tpool.execute(database.load_games)
+    replay_index = tpool.execute(database.ReplayIndex)
+    quarantine = tpool.execute(database.Quarantine)
+    checkpoints = tpool.execute(database.load_checkpoints)
+    metrics.observe("load", time.perf_counter() - start)
+    print(f"Loaded {len(games_df)} games in {time.perf_counter() - start:.2f} s.")
+
+
+def wait_for_games() -> None:
+    """Load the games on first use, later callers wait for that to finish."""
+    global games_loading
+    if games_loading is None:
+        games_loading = eventlet.spawn(load_games)
+    games_loading.wait()
+
+
+def verify_state() -> None:
+    """Recalculate the state if the saved one doesn't match the games."""
+    wait_for_games()
+    if saved_state is not None and saved_state["games"] == tpool.execute(
+        database.games_fingerprint, games_df, store_generation
+    ):
+        print("Saved state is up to date.")
+        return
+
+    reload_tier_list()
+    bump_state()
+    emit_all()
+
+
+def parse_worker() -> None:
+    while True:
+        paths, timings, started = parse_queue.get()
+        parsed = parse_new_replays(paths, timings)
+        if parsed:
+            store_queue.put((parsed, timings, started))
+
+
+def store_worker() -> None:
+    while True:
+        parsed, timings, started = store_queue.get()
+        # Batches that queued up while the last one was stored go in together.
+        while not store_queue.empty():
+            more, _, _ = store_queue.get()
+            parsed += more
+
+        with state_lock:
+            try:
+                delta = store_replays(parsed, timings)
+            except Exception:
+                traceback.print_exc()
+                continue
+
+            # Bump right away, a cached response must not pair the new state
+            # with the old version.
+            if delta and delta.get("snapshot"):
+                bump_state()
+            elif delta:
+                bump_state(delta)
+                save_state()
+        broadcast_queue.put((len(parsed), delta, timings, started))
+
+
+def broadcast_worker() -> None:
+    while True:
+        count, delta, timings, started = broadcast_queue.get()
+        with metrics.span("emit", timings):
+            if delta and delta.get("snapshot"):
+                emit_all()
+            elif delta:
+                socketio.emit("state_delta", delta)
+        metrics.observe("replay", time.perf_counter() - started, timings)
+
+        print(f"\nProcessing {count} new replays done.")
+        if settings.LOG_REPLAY_TIMINGS:
+            print(f"Replay timings: {metrics.format_timings(timings)}")
 
 
 def background_task() -> None:
     global character_ratings, games_df
 
-    reload_tier_list()
+    verify_state()
+
+    for worker in (parse_worker, store_worker, broadcast_worker):
+        socketio.start_background_task(target=worker)
 
     print("")
     spinner = ["⠋", "⠙", "⠹", "⠸", "⠼", "⠴", "⠦", "⠧", "⠇", "⠏"]
     spin_index = 0
 
+    latest_directory = ""
+    watcher = None
+    next_directory_check = 0.0
+
     while True:
-        latest_directory = find_replay_directory()
+        if time.monotonic() >= next_directory_check:
+            next_directory_check = time.monotonic() + settings.DIRECTORY_RESCAN_SECONDS
+            directory = find_replay_directory()
+            if directory != latest_directory:
+                if watcher:
+                    watcher.close()
+                latest_directory = directory
+                watcher = create_watcher(directory) if directory else None
+
+                # Pick up replays that were written while nothing was watching.
+                if watcher:
+                    for file in new_files(games_df, directory, replay_index):
+                        watcher.track(os.path.join(directory, file))
 
         sys.stdout.write(
             f"\rWatching directory: {latest_directory} {spinner[spin_index]}"
@@ -353,20 +1191,28 @@ def background_task() -> None:
         sys.stdout.flush()
         spin_index = (spin_index + 1) % len(spinner)
 
-        new_file = detect_new_files(games_df, latest_directory)
-        if new_file != "":
-            print(f"\nFound new replay: {new_file}")
+        if watcher:
+            follow_live_games(watcher.writing())
+
+        with metrics.span("poll"):
+            paths = watcher.poll() if watcher else []
 
-            path = os.path.join(latest_directory, new_file)
-            while is_file_locked(path):
-                eventlet.sleep(0.5)
+        if paths:
+            print(f"\nFound {len(paths)} new replays.")
+            timings = {}
+            for path in paths:
+                waited = watcher.waited(path)
+                if waited is not None:
+                    metrics.observe("settle", waited, timings)
+            # Blocks while the pipeline is full, so replays arriving faster
+            # than they are stored wait on disk instead of in memory.
+            parse_queue.put((paths, timings, time.perf_counter()))
 
-            process_new_replay(path)
-            print("Processing new replay done.")
+        eventlet.sleep(settings.WATCH_INTERVAL_SECONDS)
 
-            emit_all()
 
-        eventlet.sleep(0.5)
+# Serve the state of the last run until the games are loaded and checked.
+restore_saved_state()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,265 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+import database
+import recalculate_db
+import settings
+from utils.files import parse_replay
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+REPLAY_DIRS = [os.path.join(ROOT, "2024-12"), os.path.join(ROOT, "test_replays")]
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+
+# Time from importing app to the first state response, in a fresh process.
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import app
+app.app.test_client().get("/state")
+print(time.perf_counter() - start)
+"""
+
+
+def measure(
+    results: Dict,
+    name: str,
+    func: Callable,
+    repeat: int,
+    setup: Optional[Callable] = None,
+    **info,
+) -> None:
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    record(results, name, times, **info)
+
+
+def record(results: Dict, name: str, times: List[float], **info) -> None:
+    results[name] = {
+        "runs": len(times),
+        "min": min(times),
+        "mean": sum(times) / len(times),
+        "max": max(times),
+        **info,
+    }
+    print(f"{name:<40} {min(times) * 1000:>10.1f} ms")
+
+
+def synthetic_games(source: pd.DataFrame, count: int, seed: int = 0) -> pd.DataFrame:
+    """Resample stored games into `count` games with new increasing dates."""
+    rng = np.random.default_rng(seed)
+    games_df = source.iloc[rng.integers(0, len(source), count)].copy()
+    # Games are a few minutes apart, like a real set.
+    seconds = np.cumsum(rng.integers(60, 600, count))
+    games_df.index = pd.DatetimeIndex(
+        pd.Timestamp("2020-01-01", tz="UTC") + pd.to_timedelta(seconds, unit="s"),
+        name="datetime",
+    )
+    return games_df
+
+
+def replay_paths() -> List[str]:
+    return [
+        entry.path
+        for entry in recalculate_db.replay_files(REPLAY_DIRS)
+        if entry.name.endswith(".slp")
+    ]
+
+
+def benchmark_ingest(results: Dict, repeat: int, workers: int) -> None:
+    paths = replay_paths()
+    measure(
+        results,
+        "parse_replay",
+        lambda: [parse_replay(path) for path in paths],
+        repeat,
+        files=len(paths),
+    )
+
+    def clear_store():
+        shutil.rmtree(settings.DB_DIR, ignore_errors=True)
+
+    measure(
+        results,
+        "recalculate_database",
+        lambda: recalculate_db.recalculate_database(
+            overwrite=True, workers=workers, replay_dirs=REPLAY_DIRS
+        ),
+        repeat,
+        setup=clear_store,
+        files=len(paths),
+        workers=workers,
+    )
+
+
+def benchmark_startup(results: Dict, source: pd.DataFrame, size: int, repeat: int):
+    shutil.rmtree(settings.DB_DIR, ignore_errors=True)
+    database.save_games(synthetic_games(source, size))
+
+    def run(script: str) -> str:
+        return subprocess.run(
+            [sys.executable, "-c", script],
+            env=dict(os.environ, PYTHONPATH=ROOT),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+
+    # The first start calculates the state and saves it for the next ones.
+    run("import app; app.verify_state()")
+    times = [float(run(STARTUP_SCRIPT).split()[-1]) for _ in range(repeat)]
+    record(results, f"first_response[{size}]", times)
+    shutil.rmtree(settings.DB_DIR, ignore_errors=True)
+
+
+def benchmark_ratings(results: Dict, source: pd.DataFrame, size: int, repeat: int):
+    # Imported late: app loads the game store of the working directory.
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+
+        app.wait_for_games()
+
+    app.games_df = synthetic_games(source, size)
+
+    def clear_state():
+        app.range_cache.clear()
+        app.checkpoints.clear()
+
+    measure(
+        results,
+        f"reload_tier_list[{size}]",
+        app.reload_tier_list,
+        repeat,
+        setup=clear_state,
+    )
+    measure(
+        results,
+        f"reload_tier_list_checkpointed[{size}]",
+        app.reload_tier_list,
+        repeat,
+        setup=app.range_cache.clear,
+    )
+
+    def update_all_matchups():
+        for p1_character in range(26):
+            for p2_character in range(26):
+                app.update_matchups(
+                    {"character": p1_character}, {"character": p2_character}
+                )
+
+    measure(results, f"update_matchups[{size}]", update_all_matchups, repeat)
+
+    client = app.app.test_client()
+    measure(
+        results,
+        f"POST /recalculate[{size}]",
+        lambda: client.post("/recalculate"),
+        repeat,
+        setup=app.range_cache.clear,
+    )
+    measure(results, f"GET /matchups[{size}]", lambda: client.get("/matchups"), repeat)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Dict, baseline_path: str) -> None:
+    with open(baseline_path, "r") as file:
+        baseline = json.load(file)["results"]
+
+    print(f"\nChange against {baseline_path}:")
+    for name, result in results.items():
+        if name in baseline:
+            change = result["min"] / baseline[name]["min"] - 1
+            print(f"{name:<40} {change:>+10.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths.")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=DEFAULT_SIZES,
+        help="Numbers of synthetic games to rate.",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used by recalculate_database.",
+    )
+    parser.add_argument(
+        "--output", default="benchmark.json", help="File to write results to."
+    )
+    parser.add_argument(
+        "--baseline", help="Results of an earlier run to compare against."
+    )
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    # Synthetic games are resampled from the real games.
+    source = database.load_games()
+    if source.empty:
+        source = database.normalize(pd.read_pickle(settings.DB_FILE))
+
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        # Keep the real game store and tier list out of reach.
+        shutil.copy(settings.TIER_FILE_BASE, work_dir)
+        os.chdir(work_dir)
+
+        benchmark_ingest(results, args.repeat, args.workers)
+        for size in args.sizes:
+            benchmark_startup(results, source, size, args.repeat)
+            benchmark_ratings(results, source, size, args.repeat)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(output, "w") as file:
+        json.dump(
+            {
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "time": pd.Timestamp.now(tz="UTC").isoformat(),
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        compare(results, args.baseline)
@@ -1,4 +1,30 @@
+import argparse
+import json
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing, contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
 import pandas as pd
+import pyarrow as pa
+from pandas.api.types import union_categoricals
+
+import settings
+
+# Columns read from the frames of a replay. They are empty for games whose
+# frames weren't decoded and don't affect the ratings.
+frame_stat_columns = [
+    "p1_stock_losses",
+    "p2_stock_losses",
+    "p1_damage_dealt",
+    "p2_damage_dealt",
+    "last_stock",
+]
 
 columns = [
     "stage",
@@ -18,28 +44,38 @@ columns = [
     "frames",
     "ignore",
     "type",
-]
+] + frame_stat_columns
 
 types = {
-    "stage": "Int64",
-    "p1_code": "string",
-    "p1_port": "Int64",
-    "p1_character": "Int64",
-    "p1_stocks": "Int64",
-    "p2_code": "string",
-    "p2_port": "Int64",
-    "p2_character": "Int64",
-    "p2_stocks": "Int64",
-    "end_type": "Int64",
-    "lras_initiator": "Int64",
+    # Some stage ids, like those of event stages, don't fit in a byte.
+    "stage": "Int16",
+    "p1_code": "category",
+    "p1_port": "Int8",
+    "p1_character": "Int8",
+    "p1_stocks": "Int8",
+    "p2_code": "category",
+    "p2_port": "Int8",
+    "p2_character": "Int8",
+    "p2_stocks": "Int8",
+    "end_type": "Int8",
+    "lras_initiator": "Int8",
     "p1_won": "boolean",
     "p2_won": "boolean",
-    "frames": "Int64",
+    "frames": "Int32",
     "ignore": "bool",
-    "type": "string",
+    "type": "category",
+    # Frames on which the player lost each stock.
+    "p1_stock_losses": pd.ArrowDtype(pa.list_(pa.int32())),
+    "p2_stock_losses": pd.ArrowDtype(pa.list_(pa.int32())),
+    # Damage the player dealt on each of the opponent's stocks.
+    "p1_damage_dealt": pd.ArrowDtype(pa.list_(pa.float32())),
+    "p2_damage_dealt": pd.ArrowDtype(pa.list_(pa.float32())),
+    "last_stock": "boolean",
     # "datetime": "datetime64[ns]",
 }
 
+categories = [column for column, dtype in types.items() if dtype == "category"]
+
 empty = {
     "stage": -1,
     "p1_code": "",
@@ -57,8 +93,575 @@ empty = {
     "frames": -1,
     "ignore": True,
     "type": "",
+    "p1_stock_losses": None,
+    "p2_stock_losses": None,
+    "p1_damage_dealt": None,
+    "p2_damage_dealt": None,
+    "last_stock": None,
+}
+
+arrow_types = {
+    "Int8": pa.int8(),
+    "Int16": pa.int16(),
+    "Int32": pa.int32(),
+    "category": pa.dictionary(pa.int32(), pa.string()),
+    "boolean": pa.bool_(),
+    "bool": pa.bool_(),
 }
 
 
+def arrow_type(dtype: Union[str, pd.ArrowDtype]) -> pa.DataType:
+    if isinstance(dtype, pd.ArrowDtype):
+        return dtype.pyarrow_dtype
+    return arrow_types[dtype]
+
+
+schema = pa.schema(
+    [pa.field("datetime", pa.timestamp("ns", tz="UTC"), nullable=False)]
+    + [
+        pa.field(column, arrow_type(dtype), nullable=dtype != "bool")
+        for column, dtype in types.items()
+    ]
+)
+
+BASE_FILE = "games.arrow"
+SEGMENT_DIR = "segments"
+INDEX_FILE = "replays.tsv"
+CHECKPOINT_FILE = "checkpoints.pkl"
+STATE_FILE = "state.pkl"
+# Changed whenever the stored games are replaced, state and checkpoints
+# calculated from the old ones don't apply anymore.
+GENERATION_FILE = "generation"
+# Bumped when the state pickled into checkpoints changes, older ones are dropped.
+CHECKPOINT_VERSION = 5
+CACHE_FILE = "replay_cache.sqlite"
+QUARANTINE_FILE = "quarantine.json"
+# Appends go to small segment files that are merged into the base file once
+# there are this many of them.
+COMPACT_SEGMENTS = 64
+
+
 def date_exists(datetime, df):
     return pd.to_datetime(datetime) not in df.index
+
+
+def to_timestamp(value: Optional[str], end: bool = False) -> Optional[pd.Timestamp]:
+    """Parse a date range bound, dates without a time cover the whole day."""
+    if value is None or value == "":
+        return None
+
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize(settings.TIMEZONE)
+    if end and len(str(value)) == len("YYYY-MM-DD"):
+        timestamp += pd.Timedelta(days=1)
+    return timestamp
+
+
+def select_range(
+    games_df: pd.DataFrame,
+    start: Optional[pd.Timestamp] = None,
+    end: Optional[pd.Timestamp] = None,
+) -> pd.DataFrame:
+    """Games in [start, end) by binary search over the sorted index."""
+    first = 0 if start is None else games_df.index.searchsorted(start, side="left")
+    last = (
+        len(games_df) if end is None else games_df.index.searchsorted(end, side="left")
+    )
+    return games_df.iloc[first:last]
+
+
+def normalize(games_df: pd.DataFrame) -> pd.DataFrame:
+    """Convert a games frame to the `types` schema with a UTC datetime index."""
+    games_df = games_df.copy()
+    for column, dtype in types.items():
+        if column not in games_df:
+            # Games stored before the column was added.
+            games_df[column] = None
+        values = games_df[column]
+        if (
+            isinstance(dtype, str)
+            and dtype.startswith("Int")
+            and values.dtype == object
+        ):
+            # Old rows can hold enums or None instead of plain integers.
+            values = values.map(lambda v: pd.NA if pd.isna(v) else int(v))
+        if values.dtype != dtype:
+            values = values.astype(dtype)
+        games_df[column] = values
+
+    games_df.index = pd.DatetimeIndex(
+        pd.to_datetime(games_df.index, utc=True), name="datetime"
+    ).as_unit("ns")
+    return games_df[list(types)]
+
+
+def concat(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """pd.concat that keeps categorical columns categorical.
+
+    Plain concatenation falls back to object columns when the categories of
+    the frames differ.
+    """
+    games_df = pd.concat(frames)
+    for column in categories:
+        values = [frame[column] for frame in frames if len(frame)]
+        if values:
+            games_df[column] = pd.Categorical(union_categoricals(values))
+    return games_df
+
+
+def to_frame(rows: List[Dict[str, Union[int, str]]]) -> pd.DataFrame:
+    games_df = pd.DataFrame.from_records(rows, columns=columns)
+    games_df = games_df.set_index("datetime")
+    games_df.index = [pd.to_datetime(date) for date in games_df.index]
+    return normalize(games_df)
+
+
+def _write_table(games_df: pd.DataFrame, path: str) -> None:
+    table = pa.Table.from_pandas(
+        games_df.reset_index(), schema=schema, preserve_index=False
+    )
+    temp_path = f"{path}.tmp"
+    with pa.OSFile(temp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            writer.write_table(table)
+    os.replace(temp_path, path)
+
+
+def _segment_paths(db_dir: str) -> List[str]:
+    segment_dir = os.path.join(db_dir, SEGMENT_DIR)
+    if not os.path.isdir(segment_dir):
+        return []
+    return [
+        os.path.join(segment_dir, file)
+        for file in sorted(os.listdir(segment_dir))
+        if file.endswith(".arrow")
+    ]
+
+
+def read_table(
+    db_dir: str = settings.DB_DIR, columns: Optional[List[str]] = None
+) -> pa.Table:
+    """Memory map the base file and all segments into one Arrow table."""
+    paths = _segment_paths(db_dir)
+    base_path = os.path.join(db_dir, BASE_FILE)
+    if os.path.exists(base_path):
+        paths.insert(0, base_path)
+
+    tables = []
+    for path in paths:
+        table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+        # Files written before the column types were narrowed or the frame
+        # stat columns were added.
+        for field in schema:
+            if field.name not in table.column_names:
+                table = table.append_column(field, pa.nulls(len(table), field.type))
+        if table.schema != schema:
+            table = table.select(schema.names).cast(schema)
+        tables.append(table.select(columns) if columns else table)
+
+    if not tables:
+        return schema.empty_table().select(columns) if columns else schema.empty_table()
+    return pa.concat_tables(tables)
+
+
+def exists(db_dir: str = settings.DB_DIR) -> bool:
+    return os.path.exists(os.path.join(db_dir, BASE_FILE)) or bool(
+        _segment_paths(db_dir)
+    )
+
+
+def load_games(db_dir: str = settings.DB_DIR) -> pd.DataFrame:
+    if not exists(db_dir) and os.path.exists(settings.DB_FILE):
+        migrate_pickle(settings.DB_FILE, db_dir)
+
+    # List columns stay in Arrow rather than becoming a Python list per game.
+    games_df = (
+        read_table(db_dir)
+        .to_pandas(
+            types_mapper=lambda type: (
+                pd.ArrowDtype(type) if pa.types.is_list(type) else None
+            )
+        )
+        .set_index("datetime")
+    )
+    games_df = normalize(games_df)
+    # A compaction interrupted before removing its segments leaves duplicates.
+    games_df = games_df[~games_df.index.duplicated()]
+    return games_df.sort_index(kind="stable")
+
+
+def append_games(games_df: pd.DataFrame, db_dir: str = settings.DB_DIR) -> None:
+    """Write new games to their own segment without touching stored ones."""
+    if games_df.empty:
+        return
+
+    segment_dir = os.path.join(db_dir, SEGMENT_DIR)
+    os.makedirs(segment_dir, exist_ok=True)
+    paths = _segment_paths(db_dir)
+    number = int(os.path.basename(paths[-1]).split(".")[0]) + 1 if paths else 0
+    _write_table(normalize(games_df), os.path.join(segment_dir, f"{number:08d}.arrow"))
+
+    if len(paths) + 1 >= COMPACT_SEGMENTS:
+        compact(db_dir)
+
+
+def save_games(games_df: pd.DataFrame, db_dir: str = settings.DB_DIR) -> None:
+    """Replace the whole store with `games_df`."""
+    os.makedirs(db_dir, exist_ok=True)
+    _write_table(normalize(games_df), os.path.join(db_dir, BASE_FILE))
+    for path in _segment_paths(db_dir):
+        os.remove(path)
+
+
+def compact(db_dir: str = settings.DB_DIR) -> None:
+    """Merge all segments into the base file."""
+    if _segment_paths(db_dir):
+        save_games(load_games(db_dir), db_dir)
+
+
+def replace_store(source_dir: str, db_dir: str = settings.DB_DIR) -> None:
+    """Move the games and replay index built in `source_dir` over `db_dir`'s.
+
+    The store gets a new generation, so the saved state and checkpoints of
+    the old games are dropped. Safe to run again if interrupted, as long as
+    `source_dir` is still there.
+    """
+    compact(source_dir)
+    new_generation(db_dir)
+    for path in _segment_paths(db_dir):
+        os.remove(path)
+    for name in (BASE_FILE, INDEX_FILE):
+        if os.path.exists(os.path.join(source_dir, name)):
+            os.replace(os.path.join(source_dir, name), os.path.join(db_dir, name))
+    shutil.rmtree(source_dir)
+
+
+def load_generation(db_dir: str = settings.DB_DIR) -> Optional[str]:
+    """Id of the stored games, None for stores from before ids were kept."""
+    try:
+        with open(os.path.join(db_dir, GENERATION_FILE), "r") as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def new_generation(db_dir: str = settings.DB_DIR) -> None:
+    """Give the store a new id and remove what was calculated from its games."""
+    os.makedirs(db_dir, exist_ok=True)
+    path = os.path.join(db_dir, GENERATION_FILE)
+    with open(f"{path}.tmp", "w") as file:
+        file.write(uuid.uuid4().hex)
+    os.replace(f"{path}.tmp", path)
+    for name in (STATE_FILE, CHECKPOINT_FILE):
+        if os.path.exists(os.path.join(db_dir, name)):
+            os.remove(os.path.join(db_dir, name))
+
+
+def _load_pickle(name: str, db_dir: str, default=None):
+    path = os.path.join(db_dir, name)
+    if not os.path.exists(path):
+        return default
+    with open(path, "rb") as file:
+        return pickle.load(file)
+
+
+def _save_pickle(value, name: str, db_dir: str) -> None:
+    os.makedirs(db_dir, exist_ok=True)
+    path = os.path.join(db_dir, name)
+    with open(f"{path}.tmp", "wb") as file:
+        pickle.dump(value, file)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_checkpoints(db_dir: str = settings.DB_DIR) -> List[Dict]:
+    return _load_pickle(CHECKPOINT_FILE, db_dir, [])
+
+
+def save_checkpoints(checkpoints: List[Dict], db_dir: str = settings.DB_DIR) -> None:
+    _save_pickle(checkpoints, CHECKPOINT_FILE, db_dir)
+
+
+def load_state(db_dir: str = settings.DB_DIR) -> Optional[Dict]:
+    try:
+        return _load_pickle(STATE_FILE, db_dir)
+    except Exception as e:
+        # Only a shortcut, the state can always be calculated again.
+        print(f"Failed to load the saved state: {e}")
+        return None
+
+
+def save_state(state: Dict, db_dir: str = settings.DB_DIR) -> None:
+    _save_pickle(state, STATE_FILE, db_dir)
+
+
+def games_fingerprint(
+    games_df: pd.DataFrame, generation: Optional[str]
+) -> Tuple[Optional[str], int, Optional[pd.Timestamp], int]:
+    """Cheap check that the games a saved state was calculated from are unchanged.
+
+    Covers games being added and the ignore flags being changed, the only
+    edits made to stored games, and the store being replaced, as told by
+    its `generation`.
+    """
+    ignored = games_df.index[games_df["ignore"].to_numpy(dtype=bool)]
+    return (
+        generation,
+        len(games_df),
+        games_df.index[-1] if len(games_df) else None,
+        int(pd.util.hash_array(ignored.to_numpy(dtype="datetime64[ns]")).sum()),
+    )
+
+
+class ReplayIndex:
+    """Replay files that are already in the store, with their mtime and size.
+
+    Stored as an append-only log next to the game store, so recording a file
+    doesn't rewrite the index. Later lines override earlier ones.
+    """
+
+    def __init__(self, db_dir: str = settings.DB_DIR):
+        self.path = os.path.join(db_dir, INDEX_FILE)
+        self.files: Dict[str, Tuple[int, int]] = {}
+        self.lines = 0
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as file:
+                for line in file:
+                    mtime, size, path = line.rstrip("\n").split("\t", 2)
+                    self.files[path] = (int(mtime), int(size))
+                    self.lines += 1
+
+    @staticmethod
+    def key(path: str) -> str:
+        return os.path.normcase(os.path.abspath(path))
+
+    def is_new(self, path: str, stat: Optional[os.stat_result] = None) -> bool:
+        seen = self.files.get(self.key(path))
+        if seen is None:
+            return True
+        stat = stat or os.stat(path)
+        return seen != (stat.st_mtime_ns, stat.st_size)
+
+    def add(self, path: str, stat: Optional[os.stat_result] = None) -> None:
+        self.update([(path, stat or os.stat(path))])
+
+    def update(self, files: Iterable[Tuple[str, os.stat_result]]) -> None:
+        lines = []
+        for path, stat in files:
+            key = self.key(path)
+            self.files[key] = (stat.st_mtime_ns, stat.st_size)
+            lines.append(f"{stat.st_mtime_ns}\t{stat.st_size}\t{key}\n")
+        if not lines:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.writelines(lines)
+        self.lines += len(lines)
+
+    def compact(self) -> None:
+        if self.lines <= len(self.files):
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            for path, (mtime, size) in self.files.items():
+                file.write(f"{mtime}\t{size}\t{path}\n")
+        os.replace(temp_path, self.path)
+        self.lines = len(self.files)
+
+    def clear(self) -> None:
+        self.files.clear()
+        self.lines = 0
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Quarantine:
+    """Replays that failed to be ingested, with the reason and attempts.
+
+    Kept as JSON next to the game store so the failures can be looked at.
+    A file is tried again once it has changed, like a replay that was still
+    being written, or until it has failed settings.INGEST_MAX_ATTEMPTS times.
+    Saving is safe from other threads while files are added.
+    """
+
+    def __init__(self, db_dir: str = settings.DB_DIR):
+        self.path = os.path.join(db_dir, QUARANTINE_FILE)
+        self.files: Dict[str, Dict] = {}
+        self.changed = False
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.files = json.load(file)
+
+    def __contains__(self, path: str) -> bool:
+        return ReplayIndex.key(path) in self.files
+
+    def should_retry(self, path: str, stat: Optional[os.stat_result] = None) -> bool:
+        entry = self.files.get(ReplayIndex.key(path))
+        if entry is None:
+            return True
+        stat = stat or os.stat(path)
+        return (
+            entry["mtime"] != stat.st_mtime_ns
+            or entry["size"] != stat.st_size
+            or entry["attempts"] < settings.INGEST_MAX_ATTEMPTS
+        )
+
+    def add(self, path: str, stat: os.stat_result, reason: str) -> None:
+        key = ReplayIndex.key(path)
+        entry = self.files.get(key)
+        changed = entry is None or (entry["mtime"], entry["size"]) != (
+            stat.st_mtime_ns,
+            stat.st_size,
+        )
+        with self.lock:
+            self.files[key] = {
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "attempts": 1 if changed else entry["attempts"] + 1,
+                "reason": reason,
+                "time": time.time(),
+            }
+            self.changed = True
+
+    def discard(self, path: str) -> None:
+        with self.lock:
+            if self.files.pop(ReplayIndex.key(path), None) is not None:
+                self.changed = True
+
+    def save(self) -> None:
+        # Serialized, as saves write the same temporary file.
+        with self.save_lock:
+            with self.lock:
+                contents = json.dumps(self.files, indent=2, ensure_ascii=False)
+                self.changed = False
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(f"{self.path}.tmp", "w", encoding="utf-8") as file:
+                file.write(contents)
+            os.replace(f"{self.path}.tmp", self.path)
+
+
+class ReplayCache:
+    """Parsed replay facts by content fingerprint and parser version.
+
+    Lets the rows be derived again after settings change without decoding
+    the replays. Least recently used entries are evicted once the cache
+    grows past `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        db_dir: str = settings.DB_DIR,
+        max_bytes: int = settings.REPLAY_CACHE_MAX_BYTES,
+    ):
+        os.makedirs(db_dir, exist_ok=True)
+        self.path = os.path.join(db_dir, CACHE_FILE)
+        self.max_bytes = max_bytes
+        with self.connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS facts ("
+                "key TEXT, version INTEGER, facts TEXT, size INTEGER, used REAL, "
+                "PRIMARY KEY (key, version))"
+            )
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        # A connection per call, so replays can be parsed from several threads.
+        with closing(sqlite3.connect(self.path, timeout=30)) as connection:
+            with connection:
+                yield connection
+
+    def get_many(self, keys: List[str], version: int) -> Dict[str, Dict]:
+        found = {}
+        with self.connect() as connection:
+            # Stay below SQLite's limit on query parameters.
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                rows = connection.execute(
+                    f"SELECT key, facts FROM facts WHERE version = ? "
+                    f"AND key IN ({','.join('?' * len(batch))})",
+                    [version, *batch],
+                )
+                found.update((key, json.loads(facts)) for key, facts in rows)
+
+            connection.executemany(
+                "UPDATE facts SET used = ? WHERE key = ? AND version = ?",
+                [(time.time(), key, version) for key in found],
+            )
+        return found
+
+    def get(self, key: str, version: int) -> Optional[Dict]:
+        return self.get_many([key], version).get(key)
+
+    def put_many(self, items: Iterable[Tuple[str, Dict]], version: int) -> None:
+        rows = []
+        for key, facts in items:
+            facts = json.dumps(facts)
+            rows.append((key, version, facts, len(facts), time.time()))
+        with self.connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO facts VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self.evict(connection)
+
+    def put(self, key: str, version: int, facts: Dict) -> None:
+        self.put_many([(key, facts)], version)
+
+    def evict(self, connection: sqlite3.Connection) -> None:
+        size = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM facts"
+        ).fetchone()[0]
+        if size <= self.max_bytes:
+            return
+
+        # Evict down to 90% so every insert after this doesn't evict again.
+        target = size - self.max_bytes * 0.9
+        evicted = 0
+        keys = []
+        for key, version, entry_size in connection.execute(
+            "SELECT key, version, size FROM facts ORDER BY used"
+        ):
+            if evicted >= target:
+                break
+            keys.append((key, version))
+            evicted += entry_size
+
+        connection.executemany("DELETE FROM facts WHERE key = ? AND version = ?", keys)
+
+
+def migrate_pickle(
+    pickle_path: str = settings.DB_FILE, db_dir: str = settings.DB_DIR
+) -> None:
+    print(f"Migrating {pickle_path} to {db_dir}")
+    new_generation(db_dir)
+    save_games(pd.read_pickle(pickle_path), db_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the game database.")
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help=f"Convert {settings.DB_FILE} to the columnar store in {settings.DB_DIR}.",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Merge appended segments into the base file.",
+    )
+    parser.add_argument(
+        "--quarantine",
+        action="store_true",
+        help="List the replays that failed to be ingested.",
+    )
+    args = parser.parse_args()
+
+    if args.migrate:
+        migrate_pickle()
+    if args.compact:
+        compact()
+    if args.quarantine:
+        for path, entry in Quarantine().files.items():
+            print(f"{path} ({entry['attempts']} attempts): {entry['reason']}")
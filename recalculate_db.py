@@ -1,50 +1,238 @@
 import argparse
 import os
 import re
+import shutil
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, List, Optional, Tuple
 
 import pandas as pd
 
 import database
 import settings
-from utils.files import find_slippi_replay_directory, parse_replay
+from utils.files import (
+    PARSER_VERSION,
+    date_from_replay_name,
+    facts_to_row,
+    find_slippi_replay_directory,
+    missing_frame_stats,
+    read_replay_facts,
+    replay_fingerprint,
+)
 
+CHUNK_SIZE = 16
+# Directory in the game store a rebuild is written to until it's done.
+REBUILD_DIR = "rebuild"
+REPLAY_NAME_PATTERN = re.compile(r"\d{8}T\d{6}")
+
+
+def parse_file(
+    path: str, skip_frames: bool = True
+) -> Tuple[str, Optional[Dict], Optional[str]]:
+    # Runs in the worker processes, so failures are returned instead of raised.
+    try:
+        return path, read_replay_facts(path, skip_frames), None
+    except Exception as e:
+        return path, None, "".join(traceback.format_exception(e))
+
+
+def replay_date(path: str) -> Optional[pd.Timestamp]:
+    # Start time from the file name of a replay, None for other names.
+    if not REPLAY_NAME_PATTERN.search(path):
+        return None
+    return pd.to_datetime(date_from_replay_name(os.path.basename(path)))
 
-def recalculate_database(overwrite: bool = False):
-    if not overwrite and os.path.exists("db.pkl"):
-        games_df = pd.read_pickle("db.pkl")
-    else:
-        games_df = pd.DataFrame(columns=database.columns)
-        games_df = games_df.set_index("datetime")
 
-    date_pattern = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+def replay_files(replay_dirs: Optional[List[str]] = None) -> List[os.DirEntry]:
+    if replay_dirs is None:
+        date_pattern = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
 
-    slippi_directory = find_slippi_replay_directory()
+        slippi_directory = find_slippi_replay_directory()
 
-    replay_dirs = [
-        os.path.join(slippi_directory, month)
-        for month in os.listdir(slippi_directory)
-        if os.path.isdir(os.path.join(slippi_directory, month))
-        and date_pattern.match(month)
+        replay_dirs = [
+            os.path.join(slippi_directory, month)
+            for month in os.listdir(slippi_directory)
+            if os.path.isdir(os.path.join(slippi_directory, month))
+            and date_pattern.match(month)
+        ]
+
+        replay_dirs += settings.EXTRA_DIRS
+
+    return [
+        entry for dir in replay_dirs for entry in os.scandir(dir) if entry.is_file()
     ]
 
-    replay_dirs += settings.EXTRA_DIRS
 
-    for dir in replay_dirs:
-        for file in os.listdir(dir):
-            if not os.path.isfile(os.path.join(dir, file)):
-                continue
-            try:
-                data = parse_replay(os.path.join(dir, file))
-                date = pd.to_datetime(data["datetime"])
-                if date not in games_df.index:
-                    games_df.loc[date] = data
-            except Exception as e:
-                traceback.print_exc()
-                print(f"Failed to parse file {file} in reprocessing: {e}")
-                exit()
+def recalculate_database(
+    overwrite: bool = False,
+    workers: int = 1,
+    replay_dirs: Optional[List[str]] = None,
+    frame_stats: bool = settings.EXTRACT_FRAME_STATS,
+    retry_quarantined: bool = False,
+):
+    # A rebuild is written to its own directory and moved over the store once
+    # done, so the store stays usable meanwhile and an interrupted rebuild
+    # continues where it stopped.
+    db_dir = (
+        os.path.join(settings.DB_DIR, REBUILD_DIR) if overwrite else settings.DB_DIR
+    )
+    if overwrite and database.exists(db_dir):
+        print("Continuing the interrupted rebuild.")
+    elif overwrite:
+        shutil.rmtree(db_dir, ignore_errors=True)
+        database.save_games(database.to_frame([]), db_dir)
+
+    replay_index = database.ReplayIndex(db_dir)
+    quarantine = database.Quarantine()
+
+    # Only files that are new or changed since they were ingested get parsed,
+    # and failed ones only while they are retried.
+    files = {}
+    indexed = {}
+    for entry in replay_files(replay_dirs):
+        stat = entry.stat()
+        if not (retry_quarantined or quarantine.should_retry(entry.path, stat)):
+            continue
+        if replay_index.is_new(entry.path, stat):
+            files[entry.path] = stat
+        elif frame_stats and not overwrite:
+            indexed[entry.path] = stat
+    if not files and not indexed and not overwrite:
+        print("No new replays.")
+        return []
+
+    games_df = database.load_games(db_dir)
+    # Stored games without frame stats get them from their replays again.
+    unfilled = set()
+    if frame_stats and not overwrite:
+        unfilled = set(games_df.index[games_df["last_stock"].isna().to_numpy()])
+    files.update(
+        (path, stat) for path, stat in indexed.items() if replay_date(path) in unfilled
+    )
+    if not overwrite:
+        # Games stored before the index existed are matched by file name once.
+        stored = [
+            path
+            for path in files
+            if path not in indexed and replay_date(path) in games_df.index
+        ]
+        replay_index.update((path, files[path]) for path in stored)
+        for path in stored:
+            if replay_date(path) not in unfilled:
+                del files[path]
+
+    # Replays decoded before only need their rows derived again.
+    cache = database.ReplayCache()
+    keys = {}
+    for path in files:
+        try:
+            keys[path] = replay_fingerprint(path)
+        except OSError:
+            pass
+    cached = cache.get_many(list(set(keys.values())), PARSER_VERSION)
+    cached = {
+        key: facts
+        for key, facts in cached.items()
+        if not missing_frame_stats(facts, frame_stats)
+    }
+    missing = [path for path in files if keys.get(path) not in cached]
+    print(f"{len(files) - len(missing)} replays cached, decoding {len(missing)}.")
+
+    # Passed to the workers, which don't see settings changed at runtime.
+    parse = partial(parse_file, skip_frames=not frame_stats)
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(parse, missing, chunksize=CHUNK_SIZE)
+    else:
+        executor = None
+        results = map(parse, missing)
+
+    seen = set()
+    rows = []
+    filled = []
+    ingested = []
+    failures = []
+    decoded = []
+    processed = 0
+    added = 0
+
+    def save_progress():
+        # Games and the index entries of their files are saved together, so
+        # files are parsed again only if their games weren't stored.
+        nonlocal added
+        database.append_games(database.to_frame(rows), db_dir)
+        replay_index.update((path, files[path]) for path in ingested)
+        quarantine.save()
+        cache.put_many(decoded, PARSER_VERSION)
+        added += len(rows)
+        rows.clear()
+        ingested.clear()
+        decoded.clear()
 
-    games_df.to_pickle("db.pkl")
+    try:
+        for path in files:
+            if keys.get(path) in cached:
+                facts, error = cached[keys[path]], None
+            else:
+                # Decoded results come back in the order of the files.
+                _, facts, error = next(results)
+                if error is None and path in keys:
+                    decoded.append((keys[path], facts))
+
+            if error is None:
+                try:
+                    data = facts_to_row(facts)
+                    date = pd.to_datetime(data["datetime"])
+                except Exception:
+                    error = traceback.format_exc()
+
+            if error is not None:
+                print(error)
+                print(f"Failed to parse file {path}, quarantined.")
+                failures.append({"file": path, "error": error})
+                quarantine.add(path, files[path], error)
+            else:
+                quarantine.discard(path)
+                if path not in indexed:
+                    ingested.append(path)
+                if date not in games_df.index and date not in seen:
+                    seen.add(date)
+                    rows.append(data)
+                elif date in unfilled and data["last_stock"] is not None:
+                    unfilled.discard(date)
+                    filled.append(data)
+
+            processed += 1
+            if processed % settings.INGEST_BATCH_SIZE == 0:
+                save_progress()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        # Also keeps the progress of an interrupted run.
+        save_progress()
+
+    if filled:
+        # Only the frame stats are taken, the games keep their ignore flags.
+        # The decoded replays are cached, so an interrupted run loses little.
+        games_df = database.load_games(db_dir)
+        filled_df = database.to_frame(filled)
+        games_df.loc[filled_df.index, database.frame_stat_columns] = filled_df[
+            database.frame_stat_columns
+        ]
+        database.save_games(games_df, db_dir)
+
+    replay_index.compact()
+    if overwrite:
+        database.replace_store(db_dir)
+
+    print(
+        f"Added {added} games, filled in the frame stats of {len(filled)}, "
+        f"{len(failures)} files failed."
+    )
+    if failures:
+        print("See the failures with python database.py --quarantine.")
+    return failures
 
 
 if __name__ == "__main__":
@@ -52,8 +240,32 @@ if __name__ == "__main__":
     parser.add_argument(
         "--overwrite",
         action="store_true",
-        help="If set, overwrite the existing database instead of appending to it.",
+        help="If set, rebuild the database from all replays instead of appending "
+        "to it. An interrupted rebuild is continued.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to parse replays.",
+    )
+    parser.add_argument(
+        "--frame-stats",
+        action="store_true",
+        default=settings.EXTRACT_FRAME_STATS,
+        help="Decode all frames to fill in the stock loss and damage columns, "
+        "also of stored games that don't have them yet.",
+    )
+    parser.add_argument(
+        "--retry-quarantined",
+        action="store_true",
+        help="Also try again replays that failed too many times before.",
     )
     args = parser.parse_args()
 
-    recalculate_database(overwrite=args.overwrite)
+    recalculate_database(
+        overwrite=args.overwrite,
+        workers=args.workers,
+        frame_stats=args.frame_stats,
+        retry_quarantined=args.retry_quarantined,
+    )
@@ -2,8 +2,60 @@ import os
 
 TIER_FILE = "tier_list.json"
 TIER_FILE_BASE = "tier_list.json.base"
+DB_DIR = "db"
+DB_FILE = "db.pkl"
+TIMEZONE = "Europe/Helsinki"
+# Number of date ranges whose tier list is kept for instant switching.
+RANGE_CACHE_SIZE = 8
+# Bootstrap samples for matchup win rate intervals, Wilson intervals if 0.
+MATCHUP_BOOTSTRAP_SAMPLES = 0
+# Number of /stats results kept, one per filter combination.
+STATS_CACHE_SIZE = 64
+# Games between rating checkpoints used to restart recalculation.
+CHECKPOINT_INTERVAL = 1000
+# Replays recalculate_db.py ingests between saves of its progress.
+INGEST_BATCH_SIZE = 1000
+# Failed replays are tried again until they have failed this many times,
+# or whenever they change.
+INGEST_MAX_ATTEMPTS = 3
+# Size limit of the parsed replay cache, it is about 500 bytes per replay.
+REPLAY_CACHE_MAX_BYTES = 64 * 1024 * 1024
 MIN_GAME_DURATION_SECONDS = 30
+WATCH_INTERVAL_SECONDS = 0.5
+# How often to look for a new month directory.
+DIRECTORY_RESCAN_SECONDS = 60
+# A replay is considered written once its size is unchanged for this long.
+FILE_SETTLE_SECONDS = 2
+# Number of single game updates kept for clients catching up.
+DELTA_HISTORY = 256
+# Batches of replays each stage of the processing pipeline holds before the
+# previous stage waits.
+PIPELINE_QUEUE_SIZE = 16
+# Replays parsed at the same time when several arrive together.
+PARSE_THREADS = 4
+# Print how long each stage took for every new replay.
+LOG_REPLAY_TIMINGS = False
 ALLOW_EXIT = False
+# Decode every frame of new replays for the stock loss and damage columns.
+# Parsing then takes about 30 times longer than reading only the final stocks.
+EXTRACT_FRAME_STATS = False
+# Also keep and rate netplay games against players outside PLAYER_CODES.
+# Off by default so the store only holds the games it held before. Turning
+# it on only keeps new replays, rebuild with recalculate_db.py --overwrite to
+# also add older ones.
+RATE_ALL_PLAYERS = False
+# Rating of characters a player hasn't played yet.
+BASE_ELO = 1600
+# Elo update K = max(ELO_K_NUMERATOR / matches, ELO_K_MIN), a rating difference
+# of ELO_SCALE gives 10 to 1 odds. Try alternatives with simulate.py.
+ELO_K_NUMERATOR = 800
+ELO_K_MIN = 50
+ELO_SCALE = 400
+# The matchup chart shows win rates over the last MATCHUP_WINDOW games.
+# Weighted win rates also weigh the result x games ago by
+# e^(-MATCHUP_DECAY * (x - 1)), the chart itself is unweighted.
+MATCHUP_DECAY = 0.1
+MATCHUP_WINDOW = 100
 
 EXTRA_DIRS = [f"{os.path.dirname(os.path.abspath(__file__))}\\2024-12"]
 
@@ -0,0 +1,313 @@
+import argparse
+import itertools
+import json
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+import database
+import settings
+from utils import elo, players
+from utils.matchups import CHARACTER_COUNT
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Predictions are clipped away from 0 and 1 so a sure miss has a finite loss.
+EPSILON = 1e-15
+
+
+def _elo_kernel(
+    base, p1_index, p2_index, p1_score, p2_score, k_numerator, k_min, scale, expected
+):
+    # Same update as elo._replay_kernel, run for every parameter set at once.
+    # Match counts don't depend on the parameters, so they are shared.
+    elo = np.empty((len(scale), len(base)))
+    for s in range(len(scale)):
+        elo[s, :] = base
+    matches = np.zeros(len(base), dtype=np.int64)
+    for i in range(len(p1_index)):
+        a = p1_index[i]
+        b = p2_index[i]
+        matches[a] += 1
+        matches[b] += 1
+        for s in range(len(scale)):
+            rating_a = elo[s, a]
+            rating_b = elo[s, b]
+            expected_a = 1.0 / (1.0 + pow(10, ((rating_b - rating_a) / scale[s])))
+            expected_b = 1.0 / (1.0 + pow(10, ((rating_a - rating_b) / scale[s])))
+            expected[i, s] = expected_a
+            elo[s, a] = rating_a + max(k_numerator[s] / matches[a], k_min[s]) * (
+                p1_score[i] - expected_a
+            )
+            elo[s, b] = rating_b + max(k_numerator[s] / matches[b], k_min[s]) * (
+                p2_score[i] - expected_b
+            )
+
+
+def _matchup_kernel(cells, p1_score, window, ratio, expected):
+    # Decayed win rate of the cell before each game, like MatchupAggregator
+    # keeps it: the newest result weighs 1 and each older one `ratio` times
+    # the one after it. Cells without games predict even odds.
+    history = np.zeros((CHARACTER_COUNT * CHARACTER_COUNT, window), dtype=np.int64)
+    lengths = np.zeros(CHARACTER_COUNT * CHARACTER_COUNT, dtype=np.int64)
+    weighted = np.zeros((CHARACTER_COUNT * CHARACTER_COUNT, len(ratio)))
+    for i in range(len(cells)):
+        c = cells[i]
+        n = lengths[c]
+        evicted = history[c, n % window] if n >= window else 0
+        for s in range(len(ratio)):
+            if n == 0:
+                expected[i, s] = 0.5
+            else:
+                count = min(n, window)
+                if ratio[s] == 1.0:
+                    weight_sum = float(count)
+                else:
+                    weight_sum = (1.0 - ratio[s] ** count) / (1.0 - ratio[s])
+                expected[i, s] = weighted[c, s] / weight_sum
+            weighted[c, s] = weighted[c, s] * ratio[s] + p1_score[i]
+            weighted[c, s] -= evicted * ratio[s] ** window
+        history[c, n % window] = p1_score[i]
+        lengths[c] = n + 1
+
+
+def _window_kernel(cells, p1_score, known, window, expected):
+    # Unweighted win rate of the cell's last `window` results before each
+    # game, like the chart the app shows. Unknown results are left out.
+    history = np.zeros((CHARACTER_COUNT * CHARACTER_COUNT, window), dtype=np.int64)
+    lengths = np.zeros(CHARACTER_COUNT * CHARACTER_COUNT, dtype=np.int64)
+    wins = np.zeros(CHARACTER_COUNT * CHARACTER_COUNT, dtype=np.int64)
+    counts = np.zeros(CHARACTER_COUNT * CHARACTER_COUNT, dtype=np.int64)
+    for i in range(len(cells)):
+        c = cells[i]
+        n = lengths[c]
+        expected[i] = wins[c] / counts[c] if counts[c] else 0.5
+        if n >= window:
+            # Results are stored as 0 for unknown, 1 for a loss and 2 for a win.
+            evicted = history[c, n % window]
+            if evicted:
+                counts[c] -= 1
+                wins[c] -= evicted - 1
+        result = p1_score[i] + 1 if known[i] else 0
+        history[c, n % window] = result
+        if result:
+            counts[c] += 1
+            wins[c] += result - 1
+        lengths[c] = n + 1
+
+
+if njit is not None:
+    _elo_kernel = njit(cache=True)(_elo_kernel)
+    _matchup_kernel = njit(cache=True)(_matchup_kernel)
+    _window_kernel = njit(cache=True)(_window_kernel)
+
+
+def grid(**values: Sequence[float]) -> pd.DataFrame:
+    """Every combination of the given parameter values, one set per row."""
+    return pd.DataFrame(list(itertools.product(*values.values())), columns=values)
+
+
+def simulate_elo(games: pd.DataFrame, parameters: pd.DataFrame) -> np.ndarray:
+    """Expected P1 scores before each game, games by parameter sets.
+
+    `games` as returned by elo.eligible_games, `parameters` with columns
+    k_numerator, k_min and scale. Ratings start from the base tier list.
+    """
+    with open(settings.TIER_FILE_BASE, "r") as file:
+        base_ratings = json.load(file)
+    base = np.array(
+        [rating["elo"] for player in elo.PLAYERS for rating in base_ratings[player]],
+        dtype=np.float64,
+    )
+    expected = np.empty((len(games), len(parameters)))
+    _elo_kernel(
+        base,
+        games["p1_character"].to_numpy(dtype=np.int64),
+        games["p2_character"].to_numpy(dtype=np.int64) + CHARACTER_COUNT,
+        games["p1_won"].to_numpy(dtype=np.int64),
+        games["p2_won"].to_numpy(dtype=np.int64),
+        parameters["k_numerator"].to_numpy(dtype=np.float64),
+        parameters["k_min"].to_numpy(dtype=np.float64),
+        parameters["scale"].to_numpy(dtype=np.float64),
+        expected,
+    )
+    return expected
+
+
+def simulate_matchups(
+    games: pd.DataFrame, decays: Sequence[float], window: int
+) -> np.ndarray:
+    """Matchup chart win rates of P1 before each game, games by decays.
+
+    The first column is the unweighted chart the app shows, the others are
+    the decayed win rates of `decays`.
+    """
+    cells = games["p1_character"].to_numpy(dtype=np.int64) * CHARACTER_COUNT + games[
+        "p2_character"
+    ].to_numpy(dtype=np.int64)
+    p1_score = games["p1_won"].to_numpy(dtype=np.int64)
+    expected = np.empty((len(games), len(decays) + 1))
+    unweighted = np.empty(len(games))
+    _window_kernel(
+        cells, p1_score, games["known"].to_numpy(dtype=bool), window, unweighted
+    )
+    expected[:, 0] = unweighted
+    decayed = np.empty((len(games), len(decays)))
+    _matchup_kernel(
+        cells,
+        p1_score,
+        window,
+        np.exp(-np.asarray(decays, dtype=np.float64)),
+        decayed,
+    )
+    expected[:, 1:] = decayed
+    return expected
+
+
+def scores(expected: np.ndarray, outcome: np.ndarray) -> Dict[str, np.ndarray]:
+    """Log-loss and Brier score of every column of predictions."""
+    outcome = outcome[:, None]
+    clipped = np.clip(expected, EPSILON, 1 - EPSILON)
+    return {
+        "log_loss": -np.mean(
+            outcome * np.log(clipped) + (1 - outcome) * np.log(1 - clipped), axis=0
+        ),
+        "brier": np.mean((expected - outcome) ** 2, axis=0),
+    }
+
+
+def tier_list_games(games_df: pd.DataFrame) -> pd.DataFrame:
+    games = elo.eligible_games(games_df)
+    return games[players.legacy_mask(games)]
+
+
+def matchup_games(games_df: pd.DataFrame) -> pd.DataFrame:
+    # Same games as MatchupAggregator.add_games. Decayed win rates count
+    # unknown results as losses, the unweighted ones leave them out.
+    mask = (games_df["p1_code"] == settings.PLAYER_CODES["P1"]).fillna(False) & (
+        games_df["end_type"] != 7
+    ).fillna(False)
+    games = games_df.loc[mask.to_numpy(dtype=bool) & players.legacy_mask(games_df)]
+    return pd.DataFrame(
+        {
+            "p1_character": games["p1_character"].to_numpy(dtype=np.int64),
+            "p2_character": games["p2_character"].to_numpy(dtype=np.int64),
+            "p1_won": games["p1_won"].to_numpy(dtype=np.int64, na_value=0),
+            "known": games["p1_won"].notna().to_numpy(dtype=bool),
+        },
+        index=games.index,
+    )
+
+
+def report(
+    title: str,
+    parameters: pd.DataFrame,
+    results: Dict,
+    games: int,
+    metric: str = "log_loss",
+) -> None:
+    table = parameters.assign(**results).sort_values(metric)
+    print(f"\n{title}, {games} games:")
+    formatters = {name: "{:.4f}".format for name in results}
+    print(table.to_string(index=False, formatters=formatters))
+
+
+def evaluate(
+    games_df: pd.DataFrame,
+    elo_parameters: pd.DataFrame,
+    decays: List[float],
+    window: int = settings.MATCHUP_WINDOW,
+    metric: str = "log_loss",
+) -> None:
+    games = tier_list_games(games_df)
+    # Games without a winner still move the ratings but aren't scored.
+    scored = (games["p1_won"] != games["p2_won"]).to_numpy()
+    expected = simulate_elo(games, elo_parameters)
+    results = scores(expected[scored], games["p1_won"].to_numpy(dtype=float)[scored])
+    report("Tier list Elo", elo_parameters, results, int(scored.sum()), metric)
+
+    games = matchup_games(games_df)
+    expected = simulate_matchups(games, decays, window)
+    results = scores(expected, games["p1_won"].to_numpy(dtype=float))
+    report(
+        f"Matchup chart, window {window}",
+        pd.DataFrame(
+            {
+                "weighted": [False] + [True] * len(decays),
+                "decay": [np.nan] + list(decays),
+            }
+        ),
+        results,
+        len(games),
+        metric,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score rating parameters by how well they predict the games."
+    )
+    parser.add_argument(
+        "--k-numerators",
+        type=float,
+        nargs="+",
+        default=[400, 800, 1600],
+        help="Values of the numerator of K = max(numerator / matches, minimum).",
+    )
+    parser.add_argument(
+        "--k-mins",
+        type=float,
+        nargs="+",
+        default=[25, 50, 100],
+        help="Values of the minimum of K.",
+    )
+    parser.add_argument(
+        "--scales",
+        type=float,
+        nargs="+",
+        default=[200, 400, 800],
+        help="Rating differences that give 10 to 1 odds.",
+    )
+    parser.add_argument(
+        "--decays",
+        type=float,
+        nargs="+",
+        default=[0, 0.05, 0.1, 0.2, 0.5],
+        help="Decays of weighted matchup win rates, scored against the "
+        "unweighted chart the app shows.",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=settings.MATCHUP_WINDOW,
+        help="Matchup chart window.",
+    )
+    parser.add_argument(
+        "--metric",
+        choices=["log_loss", "brier"],
+        default="log_loss",
+        help="Score to sort the parameter sets by. Log-loss punishes the matchup "
+        "chart's certain predictions of cells with one sided results hard.",
+    )
+    args = parser.parse_args()
+
+    games_df = database.load_games()
+    if games_df.empty:
+        games_df = database.normalize(pd.read_pickle(settings.DB_FILE))
+
+    evaluate(
+        games_df,
+        grid(k_numerator=args.k_numerators, k_min=args.k_mins, scale=args.scales),
+        args.decays,
+        args.window,
+        args.metric,
+    )
+    print(
+        f"\nCurrent settings: K = max({settings.ELO_K_NUMERATOR} / matches, "
+        f"{settings.ELO_K_MIN}), scale {settings.ELO_SCALE}, unweighted matchup "
+        f"chart over the last {settings.MATCHUP_WINDOW} games"
+    )
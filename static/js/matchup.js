@@ -68,6 +68,53 @@ socket.on("matchup_update", (data) => {
     reRender(data);
 });
 
+let _stateVersion = null;
+
+socket.on("connect", () => {
+    // Reload the state after every (re)connect, the server may have restarted.
+    _stateVersion = null;
+});
+
+socket.on("state_version", (version) => {
+    if (_stateVersion === null) {
+        loadState();
+    } else {
+        _stateVersion = version;
+    }
+});
+
+async function loadState() {
+    try {
+        const response = await fetch("/state");
+        const state = await response.json();
+        _matchupData = { matchups: state.matchups, winner: state.winner };
+        _stateVersion = state.version;
+        populateDropdown();
+        reRender(_matchupData);
+    } catch (error) {
+        console.error("Error loading state:", error);
+    }
+}
+
+socket.on("state_delta", (delta) => {
+    console.log(delta);
+    if (_stateVersion === null || delta.version <= _stateVersion) return;
+    if (delta.version !== _stateVersion + 1) {
+        // Missed an update, ask for everything after the last applied one.
+        socket.emit("request_snapshot", { since: _stateVersion });
+        return;
+    }
+
+    _stateVersion = delta.version;
+    if (!_matchupData) return;
+    for (const cell of delta.matchups) {
+        const { p1, p2, ...data } = cell;
+        _matchupData.matchups[p1][p2] = data;
+    }
+    _matchupData.winner = delta.winner;
+    reRender(_matchupData);
+});
+
 let _k = 0;
 let _d = 0;
 
@@ -297,7 +344,12 @@ function flipMatchupChart(matchupChart) {
             return {
                 with: x.against,
                 against: x.with,
-                data: { win_rate: 1 - x.data.win_rate, matches: x.data.matches },
+                data: {
+                    win_rate: 1 - x.data.win_rate,
+                    matches: x.data.matches,
+                    ci_low: 1 - x.data.ci_high,
+                    ci_high: 1 - x.data.ci_low,
+                },
             };
         });
     });
@@ -448,7 +500,10 @@ function renderMatchupChart(matchups) {
             const cell = document.createElement("div");
             cell.classList.add("cell");
 
-            const { win_rate, matches } = col.data;
+            const { win_rate, matches, ci_low, ci_high } = col.data;
+            if (!isNaN(ci_low)) {
+                cell.title = `95% CI ${Math.round(ci_low * 100)}%-${Math.round(ci_high * 100)}%`;
+            }
 
             const winRateText = document.createElement("div");
             winRateText.innerText = Math.round(win_rate * 100) / 100;
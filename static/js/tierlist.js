@@ -10,9 +10,49 @@ socket.on("tier_update", function (data) {
 
 socket.on("results_update", function (data) {
     console.log("results_update", data);
+    _lastResults = data;
     renderLastResults(data);
 });
 
+socket.on("connect", function () {
+    // Reload the state after every (re)connect, the server may have restarted.
+    _stateVersion = null;
+});
+
+socket.on("state_version", function (version) {
+    if (_stateVersion === null) {
+        loadState();
+    } else {
+        _stateVersion = version;
+    }
+});
+
+async function loadState() {
+    try {
+        const response = await fetch("/state");
+        const state = await response.json();
+        updateTierList(state.tiers);
+        _lastResults = state.results;
+        renderLastResults(state.results);
+        _stateVersion = state.version;
+    } catch (error) {
+        console.error("Error loading state:", error);
+    }
+}
+
+socket.on("state_delta", function (delta) {
+    console.log("state_delta", delta);
+    if (_stateVersion === null || delta.version <= _stateVersion) return;
+    if (delta.version !== _stateVersion + 1) {
+        // Missed an update, ask for everything after the last applied one.
+        socket.emit("request_snapshot", { since: _stateVersion });
+        return;
+    }
+
+    applyDelta(delta);
+    _stateVersion = delta.version;
+});
+
 const CHARACTERS = [
     "CAPTAIN_FALCON",
     "DONKEY_KONG",
@@ -43,6 +83,22 @@ const CHARACTERS = [
 ];
 
 let _tierList = null;
+let _lastResults = [];
+let _stateVersion = null;
+
+function applyDelta(delta) {
+    if (_tierList && delta.tiers.length) {
+        for (const tier of delta.tiers) {
+            _tierList[tier.player][tier.character] = { elo: tier.elo, matches: tier.matches };
+        }
+        updateTierList(_tierList);
+    }
+
+    if (delta.results.length) {
+        _lastResults = _lastResults.concat(delta.results).slice(-_lastResults.length);
+        renderLastResults(_lastResults);
+    }
+}
 
 function updateTierList(data) {
     _tierList = data;
@@ -298,12 +354,12 @@ function toggleActionMenu() {
     document.querySelector(".action-buttons").classList.toggle("collapsed");
 }
 
-async function handleStartDateChange() {
+async function sendDateRange(start, end) {
     try {
         const response = await fetch("/date_range", {
             method: "POST",
             headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({ player, port }),
+            body: JSON.stringify({ start, end }),
         });
 
         const data = await response.json();
@@ -315,19 +371,28 @@ async function handleStartDateChange() {
     }
 }
 
-async function handleEndDateChange() {
-    try {
-        const response = await fetch("/port", {
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({ player, port }),
-        });
+async function handleDateChange() {
+    const start = document.getElementById("start-date").value || null;
+    const end = document.getElementById("end-date").value || null;
+    await sendDateRange(start, end);
+}
 
-        const data = await response.json();
-        if (!data.message) {
-            alert(data.error || "Failed to update date.");
-        }
-    } catch (error) {
-        console.error("Error setting date:", error);
+function formatDate(date) {
+    const month = String(date.getMonth() + 1).padStart(2, "0");
+    const day = String(date.getDate()).padStart(2, "0");
+    return `${date.getFullYear()}-${month}-${day}`;
+}
+
+async function handleDatePresetChange(preset) {
+    const today = new Date();
+    let start = null;
+    if (preset === "month") {
+        start = formatDate(new Date(today.getFullYear(), today.getMonth(), 1));
+    } else if (preset === "30days") {
+        start = formatDate(new Date(today.getFullYear(), today.getMonth(), today.getDate() - 30));
     }
+
+    document.getElementById("start-date").value = start || "";
+    document.getElementById("end-date").value = "";
+    await sendDateRange(start, null);
 }
@@ -0,0 +1,21 @@
+import os
+
+import database
+
+
+def test_replace_store_drops_derived_state(tmp_path):
+    db_dir = str(tmp_path / "db")
+    source_dir = str(tmp_path / "rebuild")
+    database.save_games(database.to_frame([]), db_dir)
+    database.save_state({"games": None}, db_dir)
+    database.save_checkpoints([{"position": 1}], db_dir)
+    database.save_games(database.to_frame([]), source_dir)
+    generation = database.load_generation(db_dir)
+
+    database.replace_store(source_dir, db_dir)
+
+    assert database.load_generation(db_dir) not in (None, generation)
+    assert database.load_state(db_dir) is None
+    assert database.load_checkpoints(db_dir) == []
+    assert not os.path.exists(source_dir)
+    assert database.load_games(db_dir).empty
@@ -0,0 +1,18 @@
+from utils import metrics
+
+
+def test_render_keeps_every_digit(monkeypatch):
+    monkeypatch.setattr(metrics, "counters", {})
+    monkeypatch.setattr(metrics, "gauges", {})
+    monkeypatch.setattr(metrics, "histograms", {})
+    metrics.increment("replays_total", 1234567)
+    metrics.increment("replays_total", 1)
+    metrics.set_gauge("queue_size", 0.1 + 0.2, stage="parse")
+    metrics.observe("parse", 1234567.125)
+
+    lines = metrics.render().splitlines()
+
+    assert "tierlist_replays_total 1234568" in lines
+    assert 'tierlist_queue_size{stage="parse"} 0.30000000000000004' in lines
+    assert 'tierlist_stage_seconds_sum{stage="parse"} 1234567.125' in lines
+    assert 'tierlist_stage_seconds_count{stage="parse"} 1' in lines
@@ -0,0 +1,66 @@
+import glob
+import os
+
+import pytest
+from peppi_py import read_slippi
+
+from utils.files import read_replay_facts
+from utils.slp import ReplayTail, read_final_stocks
+
+REPLAYS = sorted(
+    glob.glob(os.path.join(os.path.dirname(__file__), "..", "test_replays", "*.slp"))
+)
+
+
+@pytest.mark.parametrize("path", REPLAYS, ids=os.path.basename)
+def test_read_final_stocks(path):
+    game = read_slippi(path)
+    ports = [player.port.value for player in game.start.players]
+
+    stocks = read_final_stocks(path, ports, game.metadata["lastFrame"])
+
+    assert stocks == [port.leader.post.stocks[-1].as_py() for port in game.frames.ports]
+
+
+@pytest.mark.parametrize("path", REPLAYS, ids=os.path.basename)
+def test_read_final_stocks_without_last_frame(path):
+    assert read_final_stocks(path, [0], None) is None
+
+
+@pytest.mark.parametrize("path", REPLAYS, ids=os.path.basename)
+def test_replay_tail(path):
+    facts = read_replay_facts(path)
+    tail = ReplayTail(path, facts["datetime"])
+
+    tail.read()
+
+    assert tail.ended
+    assert tail.facts() == facts
+
+
+@pytest.mark.parametrize("path", REPLAYS, ids=os.path.basename)
+def test_replay_tail_while_written(path, tmp_path):
+    # Written in pieces that split events, like a replay Slippi is recording.
+    with open(path, "rb") as file:
+        data = file.read()
+    facts = read_replay_facts(path)
+    written = tmp_path / os.path.basename(path)
+    written.write_bytes(b"")
+    tail = ReplayTail(str(written), facts["datetime"])
+
+    assert tail.facts() is None
+    for end in range(0, len(data), 4093):
+        written.write_bytes(data[: end + 4093])
+        tail.read()
+        assert not tail.failed
+
+    assert tail.facts() == facts
+
+
+def test_replay_tail_old_game_end():
+    # Before replay version 2.0.0 the game end event only holds the method.
+    tail = ReplayTail("missing.slp")
+
+    tail.read_game_end(bytes([0x39, 2]))
+
+    assert tail.end == {"method": 2, "lras_initiator": None, "placements": None}
@@ -0,0 +1,95 @@
+import sys
+
+import pytest
+
+from utils.watcher import InotifyWatcher, PollingWatcher
+
+
+def test_polling_watcher_reports_settled_files(tmp_path):
+    (tmp_path / "old.slp").write_bytes(b"old")
+    watcher = PollingWatcher(str(tmp_path), settle_seconds=0)
+    path = str(tmp_path / "new.slp")
+
+    with open(path, "wb") as file:
+        file.write(b"game")
+    # The first poll only notes the size.
+    assert watcher.poll() == []
+    assert watcher.writing() == [path]
+    with open(path, "ab") as file:
+        file.write(b"more")
+    assert watcher.poll() == []
+
+    assert watcher.poll() == [path]
+    assert watcher.writing() == []
+    assert watcher.waited(path) >= 0
+    assert watcher.poll() == []
+
+
+def test_polling_watcher_waits_for_settle_time(tmp_path):
+    watcher = PollingWatcher(str(tmp_path), settle_seconds=60)
+    (tmp_path / "new.slp").write_bytes(b"game")
+
+    assert watcher.poll() == []
+    assert watcher.poll() == []
+
+
+def test_polling_watcher_forgets_removed_files(tmp_path):
+    watcher = PollingWatcher(str(tmp_path), settle_seconds=0)
+    path = tmp_path / "new.slp"
+    path.write_bytes(b"game")
+    assert watcher.poll() == []
+
+    path.unlink()
+
+    assert watcher.poll() == []
+    assert watcher.writing() == []
+    assert watcher.waited(str(path)) is None
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Linux only")
+def test_inotify_watcher_reports_closed_files(tmp_path):
+    (tmp_path / "old.slp").write_bytes(b"old")
+    watcher = InotifyWatcher(str(tmp_path), settle_seconds=60)
+    try:
+        path = str(tmp_path / "new.slp")
+        with open(path, "wb") as file:
+            file.write(b"game")
+            file.flush()
+            assert watcher.poll() == []
+            assert watcher.writing() == [path]
+
+        assert watcher.poll() == [path]
+        assert watcher.writing() == []
+        assert watcher.waited(path) >= 0
+        assert watcher.poll() == []
+    finally:
+        watcher.close()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Linux only")
+def test_inotify_watcher_reports_moved_files(tmp_path):
+    directory = tmp_path / "replays"
+    directory.mkdir()
+    watcher = InotifyWatcher(str(directory), settle_seconds=60)
+    try:
+        (tmp_path / "new.slp").write_bytes(b"game")
+        (tmp_path / "new.slp").rename(directory / "new.slp")
+
+        assert watcher.poll() == [str(directory / "new.slp")]
+    finally:
+        watcher.close()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Linux only")
+def test_inotify_watcher_settles_tracked_files(tmp_path):
+    path = tmp_path / "new.slp"
+    path.write_bytes(b"game")
+    watcher = InotifyWatcher(str(tmp_path), settle_seconds=0)
+    try:
+        # Files handed over with track() were written before watching.
+        watcher.track(str(path))
+
+        assert watcher.poll() == []
+        assert watcher.poll() == [str(path)]
+    finally:
+        watcher.close()
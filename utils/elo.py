@@ -0,0 +1,203 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+import settings
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+CHARACTER_COUNT = 26
+PLAYERS = ("P1", "P2")
+
+
+def expected_score(
+    rating_a: float, rating_b: float, scale: float = settings.ELO_SCALE
+) -> float:
+    return 1.0 / (1.0 + pow(10, ((rating_b - rating_a) / scale)))
+
+
+def k_factor(
+    matches: int,
+    numerator: float = settings.ELO_K_NUMERATOR,
+    minimum: float = settings.ELO_K_MIN,
+) -> float:
+    return max(numerator / matches, minimum)
+
+
+def new_rating(rating: float, k: float, score: int, expected: float) -> float:
+    return rating + k * (score - expected)
+
+
+def eligible_games(
+    games_df: pd.DataFrame, columns: Tuple[str, ...] = ()
+) -> pd.DataFrame:
+    # Column-wise equivalent of the checks in app.process_game. Other
+    # `columns` are passed through as they are.
+    mask = ~games_df["ignore"].astype(bool)
+    mask &= (games_df["frames"] / 60 >= settings.MIN_GAME_DURATION_SECONDS).fillna(
+        False
+    )
+    if not settings.ALLOW_EXIT:
+        mask &= (games_df["end_type"] != 7).fillna(True)
+
+    games = games_df.loc[mask.to_numpy(dtype=bool)]
+
+    # Redefine the winner as the non quitter.
+    lras_initiator = pd.to_numeric(games["lras_initiator"], errors="coerce")
+    quitted = lras_initiator.notna().to_numpy()
+    p1_won = games["p1_won"].to_numpy(dtype=bool, na_value=False)
+    p2_won = games["p2_won"].to_numpy(dtype=bool, na_value=False)
+    lras = lras_initiator.to_numpy(dtype=float, na_value=np.nan)
+    p1_won = np.where(quitted, games["p1_port"].to_numpy(dtype=float) != lras, p1_won)
+    p2_won = np.where(quitted, games["p2_port"].to_numpy(dtype=float) != lras, p2_won)
+
+    return pd.DataFrame(
+        {
+            "p1_code": games["p1_code"],
+            "p2_code": games["p2_code"],
+            "type": games["type"],
+            "p1_character": games["p1_character"].to_numpy(dtype=np.int64),
+            "p2_character": games["p2_character"].to_numpy(dtype=np.int64),
+            "p1_won": p1_won,
+            "p2_won": p2_won,
+        }
+        | {column: games[column] for column in columns},
+        index=games.index,
+    )
+
+
+def _replay_kernel(
+    elo,
+    matches,
+    p1_index,
+    p2_index,
+    p1_score,
+    p2_score,
+    p1_delta,
+    p2_delta,
+    k_numerator,
+    k_min,
+    scale,
+):
+    for i in range(len(p1_index)):
+        a = p1_index[i]
+        b = p2_index[i]
+        rating_a = elo[a]
+        rating_b = elo[b]
+
+        matches[a] += 1
+        matches[b] += 1
+
+        elo[a] = rating_a + max(k_numerator / matches[a], k_min) * (
+            p1_score[i] - 1.0 / (1.0 + pow(10, ((rating_b - rating_a) / scale)))
+        )
+        elo[b] = rating_b + max(k_numerator / matches[b], k_min) * (
+            p2_score[i] - 1.0 / (1.0 + pow(10, ((rating_a - rating_b) / scale)))
+        )
+        p1_delta[i] = elo[a] - rating_a
+        p2_delta[i] = elo[b] - rating_b
+
+
+if njit is not None:
+    _compiled_kernel = njit(cache=True)(_replay_kernel)
+else:
+    _compiled_kernel = None
+
+
+def run_kernel(
+    elo: np.ndarray,
+    matches: np.ndarray,
+    p1_index: np.ndarray,
+    p2_index: np.ndarray,
+    p1_score: np.ndarray,
+    p2_score: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Run the sequential Elo update over flat rating and match arrays.
+
+    Updates `elo` and `matches` in place and returns the per game rating
+    deltas of both players.
+    """
+    p1_delta = np.empty(len(p1_index))
+    p2_delta = np.empty(len(p1_index))
+    kernel = _compiled_kernel if _compiled_kernel is not None else _replay_kernel
+    kernel(
+        elo,
+        matches,
+        p1_index,
+        p2_index,
+        p1_score,
+        p2_score,
+        p1_delta,
+        p2_delta,
+        settings.ELO_K_NUMERATOR,
+        settings.ELO_K_MIN,
+        settings.ELO_SCALE,
+    )
+    return p1_delta, p2_delta
+
+
+def replay_ratings(
+    character_ratings: Dict[str, List[Dict[str, float]]],
+    p1_characters: np.ndarray,
+    p2_characters: np.ndarray,
+    p1_won: np.ndarray,
+    p2_won: np.ndarray,
+    compiled: bool = True,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Run the sequential Elo update over a batch of games.
+
+    Updates `character_ratings` in place and returns the per game rating
+    deltas of both players.
+    """
+    count = len(p1_characters)
+    elo = [rating["elo"] for player in PLAYERS for rating in character_ratings[player]]
+    matches = [
+        rating["matches"] for player in PLAYERS for rating in character_ratings[player]
+    ]
+    p1_index = np.asarray(p1_characters, dtype=np.int64)
+    p2_index = np.asarray(p2_characters, dtype=np.int64) + CHARACTER_COUNT
+    p1_score = np.asarray(p1_won, dtype=np.int64)
+    p2_score = np.asarray(p2_won, dtype=np.int64)
+
+    if compiled and _compiled_kernel is not None:
+        elo_array = np.array(elo, dtype=np.float64)
+        matches_array = np.array(matches, dtype=np.int64)
+        p1_delta, p2_delta = run_kernel(
+            elo_array, matches_array, p1_index, p2_index, p1_score, p2_score
+        )
+        new_elo = elo_array.tolist()
+        new_matches = matches_array.tolist()
+    else:
+        new_elo = list(elo)
+        new_matches = list(matches)
+        p1_delta = [0.0] * count
+        p2_delta = [0.0] * count
+        _replay_kernel(
+            new_elo,
+            new_matches,
+            p1_index.tolist(),
+            p2_index.tolist(),
+            p1_score.tolist(),
+            p2_score.tolist(),
+            p1_delta,
+            p2_delta,
+            settings.ELO_K_NUMERATOR,
+            settings.ELO_K_MIN,
+            settings.ELO_SCALE,
+        )
+
+    # Only touch characters that played, so unplayed ones keep their base values.
+    for p, player in enumerate(PLAYERS):
+        for c, rating in enumerate(character_ratings[player]):
+            i = p * CHARACTER_COUNT + c
+            if new_matches[i] != matches[i]:
+                rating["elo"] = new_elo[i]
+                rating["matches"] = new_matches[i]
+
+    return np.asarray(p1_delta, dtype=np.float64), np.asarray(
+        p2_delta, dtype=np.float64
+    )
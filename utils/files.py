@@ -1,21 +1,34 @@
+import hashlib
 import os
 import re
-import traceback
 from datetime import datetime
 from pprint import pprint
-from typing import Dict, Union
+from typing import Dict, Iterator, Optional, Union
 
 import pandas as pd
 import pytz
-import win32file
 from peppi_py import read_slippi
 from slippi import id
 
 import database
 import settings
+from utils.frames import frame_stats
+from utils.slp import read_final_stocks
+
+try:
+    import win32file
+except ImportError:
+    # Only Windows needs the lock check; elsewhere files are watched by size.
+    win32file = None
+
+# Bump when read_replay_facts changes, so cached facts are decoded again.
+PARSER_VERSION = 1
+FINGERPRINT_BYTES = 1 << 16
 
 
 def is_file_locked(file_path: str) -> bool:
+    if win32file is None:
+        return False
     try:
         handle = win32file.CreateFile(
             file_path,
@@ -92,143 +105,259 @@ def date_from_replay_name(filename: str) -> str:
 
     return (
         datetime.strptime(date, "%Y%m%dT%H%M%S")
-        .astimezone(pytz.timezone("Europe/Helsinki"))
+        .astimezone(pytz.timezone(settings.TIMEZONE))
         .isoformat()
     )
 
 
-def detect_new_files(games_df: pd.DataFrame, directory: str) -> str:
-    for file in os.listdir(directory):
-        if pd.to_datetime(date_from_replay_name(file)) not in games_df.index:
-            return file
+def new_files(
+    games_df: pd.DataFrame,
+    directory: str,
+    replay_index: Optional[database.ReplayIndex] = None,
+) -> Iterator[str]:
+    for entry in os.scandir(directory):
+        if not entry.is_file():
+            continue
+        if replay_index is not None and not replay_index.is_new(
+            entry.path, entry.stat()
+        ):
+            continue
+
+        if pd.to_datetime(date_from_replay_name(entry.name)) not in games_df.index:
+            yield entry.name
+        elif replay_index is not None:
+            # Stored before the index existed, don't parse its name again.
+            replay_index.add(entry.path, entry.stat())
+
+
+def detect_new_files(
+    games_df: pd.DataFrame,
+    directory: str,
+    replay_index: Optional[database.ReplayIndex] = None,
+) -> str:
+    return next(new_files(games_df, directory, replay_index), "")
+
+
+def replay_fingerprint(file_path: str) -> str:
+    """Content key of a replay for the parse cache.
+
+    Hashes the size, the start and the end of the file rather than all of it:
+    the start holds the game settings and the end the metadata with the start
+    time, so no two replays share them, and reading a whole replay would cost
+    as much as parsing it.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        digest.update(str(size).encode())
+        digest.update(file.read(FINGERPRINT_BYTES))
+        if size > FINGERPRINT_BYTES:
+            file.seek(max(size - FINGERPRINT_BYTES, FINGERPRINT_BYTES))
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def read_replay_facts(file_path: str, skip_frames: bool = True) -> Dict:
+    """Decode the game facts a row is derived from.
+
+    Facts don't depend on settings or player ports, so they can be cached
+    and turned into rows again with facts_to_row after those change. Stats
+    read from the frames are included whenever the frames were decoded.
+    """
+    # Frames are only decoded if the final stocks can't be read directly,
+    # unless the frame stats are wanted.
+    if settings.EXTRACT_FRAME_STATS:
+        skip_frames = False
+    game = read_slippi(file_path, skip_frames=skip_frames)
+
+    players = game.start.players
+    stocks = None
+    # CPU games are always ignored, so their stocks are never needed.
+    if any(player.type != 0 for player in players):
+        stocks = [None] * len(players)
+    elif game.frames is None:
+        stocks = read_final_stocks(
+            file_path,
+            [player.port.value for player in players],
+            game.metadata.get("lastFrame"),
+        )
+        if stocks is None:
+            game = read_slippi(file_path, skip_frames=False)
+    if stocks is None:
+        stocks = [port.leader.post.stocks[-1].as_py() for port in game.frames.ports]
+
+    facts = {
+        "datetime": game.metadata["startAt"],
+        "stage": game.start.stage,
+        "end_type": game.end.method.value,
+        "lras_initiator": game.end.lras_initiator,
+        "frames": game.metadata["lastFrame"],
+        "players": [],
+    }
+
+    stats = None
+    if game.frames is not None:
+        stats = frame_stats(game.frames)
+        facts["last_stock"] = stats["last_stock"]
+
+    # Notice: py-slippi has indexes depending on port and empty players in rest of the ports,
+    #         but peppi-py just lists the non empty players in port order.
+    # TODO: check if player order is consistant between lists
+    for i, (player, player_stocks, end) in enumerate(
+        zip(players, stocks, game.end.players)
+    ):
+        character = player.character
+        # If zelda or sheik, use the character with more frames.
+        if character in {id.CSSCharacter.ZELDA, id.CSSCharacter.SHEIK}:
+            chars = game.metadata["players"][str(player.port)]["characters"]
+            character = id.CSSCharacter[
+                id.InGameCharacter(int(max(chars, key=chars.get))).name
+            ].value
+
+        facts["players"].append(
+            {
+                "type": int(player.type),
+                "code": player.netplay.code,
+                "port": player.port.value,
+                "character": int(character),
+                "stocks": player_stocks,
+                "placement": end.placement,
+            }
+            | (stats["players"][i] if stats is not None else {})
+        )
 
-    return ""
+    return facts
 
 
-def parse_replay(
-    file_path: str, ports: Dict[str, int] = None, debug_print: bool = False
-) -> Dict[int, Dict[str, Union[id.CSSCharacter, bool]]]:
-    try:
-        game = read_slippi(file_path, skip_frames=False)
-        if debug_print:
-            # print(game)
-            pass
-
-        datetime = game.metadata["startAt"]
-
-        # Check and ignore CPU games.
-        for player in game.start.players:
-            if player.type != 0:
-                if debug_print:
-                    print("Non human player")
-                empty = database.empty.copy()
-                empty["datetime"] = datetime
-                return empty
-
-        # Check that both players are known if not local game.
-        game_player_codes = [
-            x.netplay.code for x in game.start.players if x.netplay.code != ""
-        ]
-        if (
-            (not settings.PLAYER_CODES["P1"] in game_player_codes)
-            or (not settings.PLAYER_CODES["P2"] in game_player_codes)
-        ) and len(game_player_codes) > 0:
+def missing_frame_stats(facts: Dict, wanted: bool) -> bool:
+    """Whether cached facts lack frame stats that are `wanted`."""
+    return wanted and facts.get("last_stock") is None
+
+
+def facts_to_row(
+    facts: Dict,
+    ports: Dict[str, int] = None,
+    debug_print: bool = False,
+) -> Dict[str, Union[int, str, bool]]:
+    datetime = facts["datetime"]
+    empty = database.empty.copy()
+    empty["datetime"] = datetime
+
+    # Check and ignore CPU games.
+    for player in facts["players"]:
+        if player["type"] != 0:
             if debug_print:
-                print("Unknown player")
-            empty = database.empty.copy()
-            empty["datetime"] = datetime
+                print("Non human player")
             return empty
 
-        # If zelda or sheik, use the character with more frames.
-        for player in game.start.players:
-            if player.character in {id.CSSCharacter.ZELDA, id.CSSCharacter.SHEIK}:
-                chars = game.metadata["players"][str(player.port)]["characters"]
-                player.character = id.CSSCharacter[
-                    id.InGameCharacter(int(max(chars, key=chars.get))).name
-                ].value
-
-        # Notice: py-slippi has indexes depending on port and empty players in rest of the ports,
-        #         but peppi-py just lists the non empty players in port order.
-        # TODO: check if player order is consistant between lists
-        p1_index = 0
-        p2_index = 1
-
-        game_p1 = {
-            "code": game.start.players[p1_index].netplay.code,
-            "port": game.start.players[p1_index].port.value
-            + 1,  # replay ports start from 0
-            "character": id.CSSCharacter(game.start.players[p1_index].character),
-            "stocks": game.frames.ports[p1_index].leader.post.stocks[-1].as_py(),
-            "won": game.end.players[p1_index].placement == 0,
-        }
+    # Check that both players are known if not local game.
+    game_player_codes = [
+        player["code"] for player in facts["players"] if player["code"] != ""
+    ]
+    if (
+        (
+            (not settings.PLAYER_CODES["P1"] in game_player_codes)
+            or (not settings.PLAYER_CODES["P2"] in game_player_codes)
+        )
+        and len(game_player_codes) > 0
+        and not settings.RATE_ALL_PLAYERS
+    ):
+        if debug_print:
+            print("Unknown player")
+        return empty
 
-        game_p2 = {
-            "code": game.start.players[p2_index].netplay.code,
-            "port": game.start.players[p2_index].port.value
-            + 1,  # replay ports start from 0
-            "character": id.CSSCharacter(game.start.players[p2_index].character),
-            "stocks": game.frames.ports[p2_index].leader.post.stocks[-1].as_py(),
-            "won": game.end.players[p2_index].placement == 0,
+    p1_index = 0
+    p2_index = 1
+
+    game_p1, game_p2 = [
+        {
+            "code": player["code"],
+            "port": player["port"] + 1,  # replay ports start from 0
+            "character": id.CSSCharacter(player["character"]),
+            "stocks": player["stocks"],
+            "won": player["placement"] == 0,
+            "stock_losses": player.get("stock_losses"),
+            "stock_damage": player.get("stock_damage"),
         }
+        for player in (facts["players"][p1_index], facts["players"][p2_index])
+    ]
 
-        # Map players code based on ports.
-        if ports and not game_p1["code"] and not game_p2["code"]:
-            if game_p1["port"] == ports["P1"] and game_p2["port"] == ports["P2"]:
-                game_p1["code"] = settings.PLAYER_CODES["P1"]
-                game_p2["code"] = settings.PLAYER_CODES["P2"]
-            elif game_p1["port"] == ports["P2"] and game_p2["port"] == ports["P1"]:
-                game_p1["code"] = settings.PLAYER_CODES["P2"]
-                game_p2["code"] = settings.PLAYER_CODES["P1"]
-            else:
-                if debug_print:
-                    print("Port mapping defined but no matching player found.")
-                empty = database.empty.copy()
-                empty["datetime"] = datetime
-                return empty
-
-        p1 = game_p1
-        p2 = game_p2
-        # Swap players so that game_p1 matches database P1.
-        if not p1["code"] == settings.PLAYER_CODES["P1"]:
-            temp = p1
-            p1 = p2
-            p2 = temp
-
-        # if p1["won"] == 1.0 or p1["won"] == 0.0 or p2["won"] == 1.0 or p2["won"] == 0.0:
-        #     print(p1, p2)
-
-        # replay ports start from 0
-        lras_initiator = game.end.lras_initiator
-        lras_initiator = lras_initiator + 1 if lras_initiator else lras_initiator
-
-        data = {
-            "stage": game.start.stage,
-            "p1_code": p1["code"],
-            "p1_port": p1["port"],
-            "p1_character": p1["character"],
-            "p1_stocks": p1["stocks"],
-            "p2_code": p2["code"],
-            "p2_port": p2["port"],
-            "p2_character": p2["character"],
-            "p2_stocks": p2["stocks"],
-            "end_type": game.end.method.value,
-            "lras_initiator": lras_initiator,
-            "p1_won": p1["won"],
-            "p2_won": p2["won"],
-            "datetime": datetime,
-            "frames": game.metadata["lastFrame"],
-            "ignore": False,
-            "type": "netplay" if len(game_player_codes) else "local",
-        }
+    # Map players code based on ports.
+    if ports and not game_p1["code"] and not game_p2["code"]:
+        if game_p1["port"] == ports["P1"] and game_p2["port"] == ports["P2"]:
+            game_p1["code"] = settings.PLAYER_CODES["P1"]
+            game_p2["code"] = settings.PLAYER_CODES["P2"]
+        elif game_p1["port"] == ports["P2"] and game_p2["port"] == ports["P1"]:
+            game_p1["code"] = settings.PLAYER_CODES["P2"]
+            game_p2["code"] = settings.PLAYER_CODES["P1"]
+        else:
+            if debug_print:
+                print("Port mapping defined but no matching player found.")
+            return empty
 
-        if debug_print:
-            pprint(data)
+    p1 = game_p1
+    p2 = game_p2
+    # Swap players so that game_p1 matches database P1.
+    if not p1["code"] == settings.PLAYER_CODES["P1"]:
+        temp = p1
+        p1 = p2
+        p2 = temp
+
+    # replay ports start from 0
+    lras_initiator = facts["lras_initiator"]
+    lras_initiator = lras_initiator + 1 if lras_initiator else lras_initiator
+
+    data = {
+        "stage": facts["stage"],
+        "p1_code": p1["code"],
+        "p1_port": p1["port"],
+        "p1_character": p1["character"],
+        "p1_stocks": p1["stocks"],
+        "p2_code": p2["code"],
+        "p2_port": p2["port"],
+        "p2_character": p2["character"],
+        "p2_stocks": p2["stocks"],
+        "end_type": facts["end_type"],
+        "lras_initiator": lras_initiator,
+        "p1_won": p1["won"],
+        "p2_won": p2["won"],
+        "datetime": datetime,
+        "frames": facts["frames"],
+        "ignore": False,
+        "type": "netplay" if len(game_player_codes) else "local",
+        "p1_stock_losses": p1["stock_losses"],
+        "p2_stock_losses": p2["stock_losses"],
+        # Damage dealt on a stock is the damage the opponent took on it.
+        "p1_damage_dealt": p2["stock_damage"],
+        "p2_damage_dealt": p1["stock_damage"],
+        "last_stock": facts.get("last_stock"),
+    }
+
+    if debug_print:
+        pprint(data)
+
+    return data
 
-        return data
 
-    except Exception as e:
-        print(f"An error occurred while parsing the file {file_path}: {e}")
-        traceback.print_exc()
-        empty = database.empty.copy()
-        empty["datetime"] = date_from_replay_name(file_path.split("\\")[-1])
-        return empty
+def parse_replay(
+    file_path: str,
+    ports: Dict[str, int] = None,
+    debug_print: bool = False,
+    skip_frames: bool = True,
+    cache: Optional[database.ReplayCache] = None,
+) -> Dict[str, Union[int, str, bool]]:
+    """Row of a replay, raises if the replay can't be parsed.
+
+    Failed replays are left out of the store rather than stored as ignored
+    rows, so they can be quarantined and tried again.
+    """
+    facts = None
+    if cache is not None:
+        key = replay_fingerprint(file_path)
+        facts = cache.get(key, PARSER_VERSION)
+    if facts is None or missing_frame_stats(facts, settings.EXTRACT_FRAME_STATS):
+        facts = read_replay_facts(file_path, skip_frames)
+        if cache is not None:
+            cache.put(key, PARSER_VERSION, facts)
+
+    return facts_to_row(facts, ports, debug_print)
@@ -0,0 +1,42 @@
+from typing import Dict, List
+
+import numpy as np
+
+
+def stock_stats(
+    frame_ids: np.ndarray, stocks: np.ndarray, percent: np.ndarray
+) -> Dict[str, List]:
+    """Frames a player lost their stocks on and the damage taken on each stock."""
+    lost = np.flatnonzero(stocks[1:] < stocks[:-1]) + 1
+    # The percent stays for a few frames after a stock is lost, so the damage
+    # of a stock is the percent on the frame before it was lost.
+    damage = percent[lost - 1]
+    if len(stocks) and stocks[-1] > 0:
+        damage = np.append(damage, percent[-1])
+    return {
+        "stock_losses": frame_ids[lost].tolist(),
+        "stock_damage": damage.tolist(),
+    }
+
+
+def frame_stats(frames) -> Dict:
+    """Stock and damage stats of every player from peppi's decoded frames.
+
+    Reads the Arrow columns of the frames as numpy arrays in one pass over
+    each, so no Python objects are made per frame.
+    """
+    frame_ids = frames.id.to_numpy(zero_copy_only=False)
+    stocks = [
+        port.leader.post.stocks.to_numpy(zero_copy_only=False) for port in frames.ports
+    ]
+    percents = [
+        port.leader.post.percent.to_numpy(zero_copy_only=False) for port in frames.ports
+    ]
+    return {
+        # Every player was on their last stock at the same time.
+        "last_stock": bool(np.logical_and.reduce([s == 1 for s in stocks]).any()),
+        "players": [
+            stock_stats(frame_ids, player_stocks, percent)
+            for player_stocks, percent in zip(stocks, percents)
+        ],
+    }
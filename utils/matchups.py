@@ -0,0 +1,199 @@
+import math
+from collections import deque
+from typing import Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+import settings
+from utils import players
+
+WINDOW = settings.MATCHUP_WINDOW
+DECAY = settings.MATCHUP_DECAY
+CHARACTER_COUNT = 26
+# Normal quantile of the two sided 95% confidence intervals.
+CONFIDENCE_Z = 1.959963984540054
+
+EMPTY_CELL = {"win_rate": "nan", "matches": 0, "ci_low": "nan", "ci_high": "nan"}
+
+
+def empty_chart() -> List[List[Dict]]:
+    return [[EMPTY_CELL] * CHARACTER_COUNT for _ in range(CHARACTER_COUNT)]
+
+
+def wilson_intervals(
+    wins: np.ndarray, games: np.ndarray, z: float = CONFIDENCE_Z
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Wilson score intervals of win rates, nan where there are no games."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = wins / games
+        spread = z**2 / games
+        center = (rate + spread / 2) / (1 + spread)
+        half = z * np.sqrt(rate * (1 - rate) / games + spread / games / 4)
+        half /= 1 + spread
+    return center - half, center + half
+
+
+def bootstrap_intervals(
+    wins: np.ndarray, games: np.ndarray, samples: int, seed: int = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Percentile bootstrap intervals of win rates, drawn for all cells at once.
+
+    Resampling the n results of a cell with w wins gives Binomial(n, w / n)
+    wins, so the (samples x cells) matrix of resampled wins is drawn from
+    that directly instead of resampling every cell's results.
+    """
+    rng = np.random.default_rng(seed)
+    played = games > 0
+    rate = np.divide(wins, games, out=np.zeros(games.shape), where=played)
+    resampled = rng.binomial(games, rate, size=(samples, *games.shape))
+    tail = (1 - math.erf(CONFIDENCE_Z / math.sqrt(2))) / 2 * 100
+    # Percentiles of the win counts scale to those of the win rates.
+    low, high = np.percentile(resampled, [tail, 100 - tail], axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        low, high = low / games, high / games
+    return low, high
+
+
+class MatchupAggregator:
+    """Rolling per (p1_character, p2_character) window of P1 results.
+
+    Holds the last `window` results of every character pair together with
+    running sums, so adding a game and reading a cell are both O(1).
+    """
+
+    def __init__(self, window: int = WINDOW, decay: float = DECAY):
+        self.window = window
+        # Weight of the result at age a (0 = newest) is e^(-decay * (a - 1)).
+        self.ratio = math.exp(-decay)
+        self.newest_weight = math.exp(decay)
+        self.evicted_ratio = self.ratio**window
+        self.reset()
+
+    def reset(self) -> None:
+        self.results: Dict[tuple, deque] = {}
+        self.wins: Dict[tuple, int] = {}
+        self.known: Dict[tuple, int] = {}
+        self.weighted_wins: Dict[tuple, float] = {}
+
+    def add_game(self, data: Dict[str, Union[int, str]]) -> None:
+        # Same rows update_matchups used to select from games_df.
+        p1_code = data["p1_code"]
+        if pd.isna(p1_code) or p1_code != settings.PLAYER_CODES["P1"]:
+            return
+        if not players.is_legacy_game(data):
+            return
+        if pd.isna(data["end_type"]) or data["end_type"] == 7:
+            return
+
+        self.add(data["p1_character"], data["p2_character"], data["p1_won"])
+
+    def add_games(self, games_df: pd.DataFrame) -> None:
+        mask = (games_df["p1_code"] == settings.PLAYER_CODES["P1"]).fillna(False) & (
+            games_df["end_type"] != 7
+        ).fillna(False)
+        games = games_df.loc[mask.to_numpy(dtype=bool) & players.legacy_mask(games_df)]
+        for p1_character, p2_character, p1_won in zip(
+            games["p1_character"].tolist(),
+            games["p2_character"].tolist(),
+            games["p1_won"].tolist(),
+        ):
+            self.add(p1_character, p2_character, p1_won)
+
+    def add(self, p1_character: int, p2_character: int, p1_won) -> None:
+        key = (int(p1_character), int(p2_character))
+        results = self.results.get(key)
+        if results is None:
+            results = self.results[key] = deque()
+            self.wins[key] = 0
+            self.known[key] = 0
+            self.weighted_wins[key] = 0.0
+
+        won = None if pd.isna(p1_won) else bool(p1_won)
+
+        weighted = self.weighted_wins[key] * self.ratio
+        if won:
+            weighted += self.newest_weight
+
+        if len(results) == self.window:
+            evicted = results.popleft()
+            if evicted is not None:
+                self.known[key] -= 1
+                if evicted:
+                    self.wins[key] -= 1
+                    weighted -= self.newest_weight * self.evicted_ratio
+
+        results.append(won)
+        if won is not None:
+            self.known[key] += 1
+            if won:
+                self.wins[key] += 1
+        self.weighted_wins[key] = weighted
+
+    def cells(
+        self,
+        keys: List[Tuple[int, int]],
+        weighted: bool = True,
+        bootstrap: int = settings.MATCHUP_BOOTSTRAP_SAMPLES,
+    ) -> List[Dict[str, Union[float, str, int]]]:
+        """Chart cells of character pairs, computed together in one pass.
+
+        Intervals are Wilson score intervals of the window's results, or
+        percentile bootstrap ones if `bootstrap` samples are asked for.
+        """
+        matches = np.array([len(self.results.get(key, ())) for key in keys])
+        known = np.array([self.known.get(key, 0) for key in keys])
+        wins = np.array([self.wins.get(key, 0) for key in keys])
+
+        if bootstrap:
+            low, high = bootstrap_intervals(wins, known, bootstrap)
+        else:
+            low, high = wilson_intervals(wins, known)
+
+        if weighted:
+            weighted_wins = np.array([self.weighted_wins.get(key, 0) for key in keys])
+            if self.ratio == 1:
+                # No decay, every result weighs the same.
+                weight_sum = self.newest_weight * matches
+            else:
+                weight_sum = (
+                    self.newest_weight * (1 - self.ratio**matches) / (1 - self.ratio)
+                )
+            with np.errstate(divide="ignore", invalid="ignore"):
+                win_rate = weighted_wins / weight_sum
+            # Results of unknown outcome still count as losses here.
+            defined = matches > 0
+        else:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                win_rate = wins / known
+            defined = known > 0
+
+        has_interval = known > 0
+        return [
+            (
+                {
+                    "win_rate": float(win_rate[i]) if defined[i] else "nan",
+                    "matches": int(matches[i]),
+                    "ci_low": float(low[i]) if has_interval[i] else "nan",
+                    "ci_high": float(high[i]) if has_interval[i] else "nan",
+                }
+                if matches[i]
+                else EMPTY_CELL
+            )
+            for i in range(len(keys))
+        ]
+
+    def result(
+        self, p1_character: int, p2_character: int, weighted: bool = True
+    ) -> Dict[str, Union[float, str, int]]:
+        return self.cells([(int(p1_character), int(p2_character))], weighted)[0]
+
+    def chart(
+        self, pairs: Iterable[Tuple[int, int]], weighted: bool = True
+    ) -> List[List[Dict]]:
+        """Full matchup chart with cells filled in for `pairs`."""
+        keys = [(int(p1), int(p2)) for p1, p2 in pairs]
+        chart = empty_chart()
+        for (p1_character, p2_character), cell in zip(keys, self.cells(keys, weighted)):
+            chart[p1_character][p2_character] = cell
+        return chart
@@ -0,0 +1,97 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+PREFIX = "tierlist"
+# Upper bounds of the stage duration histogram buckets, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+counters: Dict[Tuple[str, Tuple], float] = {}
+gauges: Dict[Tuple[str, Tuple], float] = {}
+histograms: Dict[str, List[float]] = {}
+
+descriptions = {
+    "stage_seconds": "Time spent in each stage of replay processing.",
+    "replays_total": "Replays processed after being picked up by the watcher.",
+    "replay_parse_failures_total": "Replays that could not be parsed.",
+    "games_ignored_total": "Games left out of the ratings, by reason.",
+    "queue_size": "Batches of replays waiting in each stage of the processing pipeline.",
+}
+
+
+def increment(name: str, amount: float = 1, **labels: str) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    counters[key] = counters.get(key, 0) + amount
+
+
+def set_gauge(name: str, value: float, **labels: str) -> None:
+    gauges[(name, tuple(sorted(labels.items())))] = value
+
+
+def observe(
+    stage: str, seconds: float, timings: Optional[Dict[str, float]] = None
+) -> None:
+    """Record a stage duration, also into `timings` of a single replay."""
+    counts = histograms.setdefault(stage, [0] * (len(BUCKETS) + 2))
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            counts[i] += 1
+    # The last two slots hold the count and the sum.
+    counts[-2] += 1
+    counts[-1] += seconds
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0) + seconds
+
+
+@contextmanager
+def span(stage: str, timings: Optional[Dict[str, float]] = None) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, timings)
+
+
+def format_timings(timings: Dict[str, float]) -> str:
+    return ", ".join(
+        f"{stage} {seconds * 1000:.1f} ms" for stage, seconds in timings.items()
+    )
+
+
+def _labels(labels: Tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def _value(value: float) -> str:
+    # Integers as they are, floats with every digit, large totals stay exact.
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    name = f"{PREFIX}_stage_seconds"
+    lines.append(f"# HELP {name} {descriptions['stage_seconds']}")
+    lines.append(f"# TYPE {name} histogram")
+    for stage, counts in histograms.items():
+        for bound, count in zip(BUCKETS, counts):
+            lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {counts[-2]}')
+        lines.append(f'{name}_sum{{stage="{stage}"}} {_value(counts[-1])}')
+        lines.append(f'{name}_count{{stage="{stage}"}} {counts[-2]}')
+
+    for kind, values in (("counter", counters), ("gauge", gauges)):
+        for metric in sorted({name for name, _ in values}):
+            name = f"{PREFIX}_{metric}"
+            if metric in descriptions:
+                lines.append(f"# HELP {name} {descriptions[metric]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (key, labels), value in sorted(values.items()):
+                if key == metric:
+                    lines.append(f"{name}{_labels(labels)} {_value(value)}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,191 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+import settings
+from utils import elo
+
+CHARACTER_COUNT = elo.CHARACTER_COUNT
+# Player ids must stay below this for matchup keys to be unique.
+PLAYER_LIMIT = 1 << 24
+
+
+def legacy_mask(games_df: pd.DataFrame) -> np.ndarray:
+    """Games of the P1/P2 tier list: local games and the two players' netplay."""
+    netplay = games_df["type"] == "netplay"
+    known = (games_df["p1_code"] == settings.PLAYER_CODES["P1"]) & (
+        games_df["p2_code"] == settings.PLAYER_CODES["P2"]
+    )
+    return (~netplay | known).to_numpy(dtype=bool)
+
+
+def is_legacy_game(data: Dict) -> bool:
+    return data["type"] != "netplay" or (
+        data["p1_code"] == settings.PLAYER_CODES["P1"]
+        and data["p2_code"] == settings.PLAYER_CODES["P2"]
+    )
+
+
+def pair_key(first, second, first_character, second_character):
+    """Key of a character matchup between two players, by player ids."""
+    return (
+        (np.int64(first) * PLAYER_LIMIT + second) * CHARACTER_COUNT + first_character
+    ) * CHARACTER_COUNT + second_character
+
+
+class PlayerRatings:
+    """Per character Elo of every player seen in the games.
+
+    Players are interned to dense ids that index rows of the rating arrays,
+    so looking up or updating a rating stays O(1) however many players
+    there are. Character matchups are counted for every pair of players,
+    in amortized O(1) per cell played.
+    """
+
+    def __init__(self, base_elo: float = settings.BASE_ELO):
+        self.base_elo = base_elo
+        self.ids: Dict[str, int] = {}
+        self.codes: List[str] = []
+        self.elo = np.full((16, CHARACTER_COUNT), base_elo)
+        self.matches = np.zeros((16, CHARACTER_COUNT), dtype=np.int64)
+        # Sparse matchup counts: rows by pair_key of (lower player id, higher
+        # player id, lower id's character, higher id's character) holding the
+        # wins of both players and the games. Only cells that were played
+        # take space, however many players there are.
+        self.pair_rows: Dict[int, int] = {}
+        self.pair_counts = np.zeros((16, 3), dtype=np.int32)
+
+    def intern(self, code: str) -> int:
+        player = self.ids.get(code)
+        if player is None:
+            player = self.ids[code] = len(self.codes)
+            self.codes.append(code)
+            if player == len(self.elo):
+                # Grow by doubling so interning stays amortized O(1).
+                self.elo = np.concatenate(
+                    [self.elo, np.full_like(self.elo, self.base_elo)]
+                )
+                self.matches = np.concatenate(
+                    [self.matches, np.zeros_like(self.matches)]
+                )
+        return player
+
+    def add_games(self, games: pd.DataFrame) -> None:
+        """Rate games in order, `games` as returned by elo.eligible_games."""
+        known = (
+            games["p1_code"].notna()
+            & games["p2_code"].notna()
+            & (games["p1_code"] != "")
+            & (games["p2_code"] != "")
+        )
+        games = games[known.to_numpy(dtype=bool)]
+        if games.empty:
+            return
+
+        codes = pd.unique(
+            np.concatenate(
+                [
+                    games["p1_code"].to_numpy(dtype=object),
+                    games["p2_code"].to_numpy(dtype=object),
+                ]
+            )
+        )
+        ids = {code: self.intern(code) for code in codes}
+        p1_players = games["p1_code"].map(ids).to_numpy(dtype=np.int64)
+        p2_players = games["p2_code"].map(ids).to_numpy(dtype=np.int64)
+        p1_characters = games["p1_character"].to_numpy(dtype=np.int64)
+        p2_characters = games["p2_character"].to_numpy(dtype=np.int64)
+        p1_won = games["p1_won"].to_numpy(dtype=np.int64)
+        p2_won = games["p2_won"].to_numpy(dtype=np.int64)
+
+        # The arrays are updated in place through flat views of them.
+        elo.run_kernel(
+            self.elo.reshape(-1),
+            self.matches.reshape(-1),
+            p1_players * CHARACTER_COUNT + p1_characters,
+            p2_players * CHARACTER_COUNT + p2_characters,
+            p1_won,
+            p2_won,
+        )
+
+        # Count matchups from the side of the lower player id.
+        swap = p1_players > p2_players
+        keys = pair_key(
+            np.where(swap, p2_players, p1_players),
+            np.where(swap, p1_players, p2_players),
+            np.where(swap, p2_characters, p1_characters),
+            np.where(swap, p1_characters, p2_characters),
+        )
+        keys, inverse = np.unique(keys, return_inverse=True)
+        counts = np.stack(
+            [
+                np.bincount(inverse, weights, minlength=len(keys))
+                for weights in (
+                    np.where(swap, p2_won, p1_won),
+                    np.where(swap, p1_won, p2_won),
+                    None,
+                )
+            ],
+            axis=1,
+        ).astype(np.int32)
+
+        rows = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys.tolist()):
+            row = self.pair_rows.get(key)
+            if row is None:
+                row = self.pair_rows[key] = len(self.pair_rows)
+                if row == len(self.pair_counts):
+                    # Grow by doubling so adding cells stays amortized O(1).
+                    self.pair_counts = np.concatenate(
+                        [self.pair_counts, np.zeros_like(self.pair_counts)]
+                    )
+            rows[i] = row
+        self.pair_counts[rows] += counts
+
+    def ratings(self, code: str) -> Optional[List[Dict[str, float]]]:
+        player = self.ids.get(code)
+        if player is None:
+            return None
+        return [
+            {"elo": float(rating), "matches": int(matches)}
+            for rating, matches in zip(self.elo[player], self.matches[player])
+        ]
+
+    def players(self) -> List[Dict[str, int]]:
+        games = self.matches[: len(self.codes)].sum(axis=1)
+        return sorted(
+            (
+                {"code": code, "games": int(count)}
+                for code, count in zip(self.codes, games)
+            ),
+            key=lambda player: -player["games"],
+        )
+
+    def matchups(self, code: str, opponent: str) -> Optional[List[List[Dict]]]:
+        """Chart of `code`'s characters (rows) against `opponent`'s (columns)."""
+        if code not in self.ids or opponent not in self.ids:
+            return None
+        a, b = self.ids[code], self.ids[opponent]
+        first = int(pair_key(min(a, b), max(a, b), 0, 0))
+        pair = np.zeros((3, CHARACTER_COUNT * CHARACTER_COUNT), dtype=np.int64)
+        for cell in range(CHARACTER_COUNT * CHARACTER_COUNT):
+            row = self.pair_rows.get(first + cell)
+            if row is not None:
+                pair[:, cell] = self.pair_counts[row]
+        pair = pair.reshape(3, CHARACTER_COUNT, CHARACTER_COUNT)
+        if a <= b:
+            wins, games = pair[0], pair[2]
+        else:
+            wins, games = pair[1].T, pair[2].T
+
+        return [
+            [
+                {
+                    "win_rate": wins[i, j] / games[i, j] if games[i, j] else "nan",
+                    "matches": int(games[i, j]),
+                }
+                for j in range(CHARACTER_COUNT)
+            ]
+            for i in range(CHARACTER_COUNT)
+        ]
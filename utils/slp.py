@@ -0,0 +1,298 @@
+import os
+import struct
+from typing import Dict, List, Optional
+
+from slippi import id
+
+# Raw .slp layout: a UBJSON object whose "raw" element is the event stream.
+RAW_HEADER = b"{U\x03raw[$U#l"
+RAW_START = len(RAW_HEADER) + 4
+
+EVENT_PAYLOADS = 0x35
+GAME_START = 0x36
+POST_FRAME_UPDATE = 0x38
+GAME_END = 0x39
+
+# Offsets into events, counting the command byte.
+GAME_START_STAGE = 0x13
+GAME_START_PLAYERS = 0x65
+GAME_START_PLAYER_SIZE = 0x24
+GAME_START_CODES = 0x221
+GAME_START_CODE_SIZE = 0x0A
+POST_FRAME_CHARACTER = 0x7
+POST_FRAME_STOCKS = 0x21
+GAME_END_METHOD = 0x1
+GAME_END_LRAS = 0x2
+GAME_END_PLACEMENTS = 0x3
+
+PLAYER_EMPTY = 3
+
+TAIL_SIZE = 1 << 16
+
+
+def read_payload_sizes(file) -> Optional[Dict[int, int]]:
+    file.seek(0)
+    header = file.read(RAW_START + 2)
+    if len(header) < RAW_START + 2 or not header.startswith(RAW_HEADER):
+        return None
+    if header[RAW_START] != EVENT_PAYLOADS:
+        return None
+
+    payload = file.read(header[RAW_START + 1] - 1)
+    sizes = {EVENT_PAYLOADS: header[RAW_START + 1]}
+    for i in range(0, len(payload) - 2, 3):
+        sizes[payload[i]] = struct.unpack(">H", payload[i + 1 : i + 3])[0]
+
+    return sizes
+
+
+def read_final_stocks(
+    file_path: str, ports: List[int], last_frame: Optional[int]
+) -> Optional[List[int]]:
+    """Read the stocks left for each port from the last post frame updates.
+
+    Seeks to the end of the raw event stream and searches backwards for the
+    leader post frame update of `last_frame` for every port, instead of
+    decoding all frames. Returns None if the events cannot be found, in
+    which case the caller should fall back to a full decode.
+    """
+    if last_frame is None:
+        return None
+
+    with open(file_path, "rb") as file:
+        sizes = read_payload_sizes(file)
+        if sizes is None or POST_FRAME_UPDATE not in sizes:
+            return None
+
+        file.seek(len(RAW_HEADER))
+        raw_length = struct.unpack(">I", file.read(4))[0]
+        # Raw length is left as zero while the game is still being written.
+        if raw_length == 0:
+            return None
+        raw_end = min(RAW_START + raw_length, os.fstat(file.fileno()).st_size)
+
+        event_size = sizes[POST_FRAME_UPDATE] + 1
+        tail_size = TAIL_SIZE
+        while True:
+            tail_start = max(raw_end - tail_size, RAW_START)
+            file.seek(tail_start)
+            tail = file.read(raw_end - tail_start)
+
+            stocks = []
+            for port in ports:
+                pattern = (
+                    bytes([POST_FRAME_UPDATE])
+                    + struct.pack(">i", last_frame)
+                    + bytes([port, 0])
+                )
+                position = tail.rfind(pattern)
+                # Make sure the match is an event boundary and not event data.
+                while position != -1:
+                    next_event = position + event_size
+                    if next_event == len(tail) or (
+                        next_event < len(tail) and tail[next_event] in sizes
+                    ):
+                        break
+                    position = tail.rfind(pattern, 0, position)
+
+                if position == -1 or position + event_size > len(tail):
+                    break
+                stocks.append(tail[position + POST_FRAME_STOCKS])
+
+            if len(stocks) == len(ports):
+                return stocks
+            if tail_start == RAW_START:
+                return None
+            tail_size *= 4
+
+
+class ReplayTail:
+    """Follows a replay while Slippi is still writing it.
+
+    Every read() decodes the events appended since the last one, keeping
+    the game settings, the current stocks and, once the game end event
+    has been written, how the game ended. Facts are in the same form as
+    files.read_replay_facts returns. The start time is only written to the
+    metadata after the game, so `datetime` has to be given.
+    """
+
+    def __init__(self, path: str, datetime: Optional[str] = None):
+        self.path = path
+        self.datetime = datetime
+        self.offset = RAW_START
+        self.sizes: Optional[Dict[int, int]] = None
+        self.buffer = b""
+        self.stage: Optional[int] = None
+        self.players: List[Dict] = []
+        self.frame: Optional[int] = None
+        self.stocks: Dict[int, int] = {}
+        # Frames played as each in game character, for Zelda and Sheik.
+        self.characters: Dict[int, Dict[int, int]] = {}
+        self.end: Optional[Dict] = None
+        # Set when the file can't be read as a replay, it is left to the
+        # parse of the finished file then.
+        self.failed = False
+
+    @property
+    def started(self) -> bool:
+        return self.stage is not None
+
+    @property
+    def ended(self) -> bool:
+        return self.end is not None
+
+    def read(self) -> bool:
+        """Decode newly written events. Returns True if the stocks changed."""
+        if self.failed or self.ended:
+            return False
+
+        try:
+            with open(self.path, "rb") as file:
+                if self.sizes is None:
+                    self.sizes = read_payload_sizes(file)
+                    if self.sizes is None:
+                        # The event payloads may not be written yet.
+                        return False
+                    self.offset = RAW_START + self.sizes[EVENT_PAYLOADS] + 1
+                # The buffer holds an event that wasn't completely written yet.
+                file.seek(self.offset + len(self.buffer))
+                self.buffer += file.read()
+        except OSError:
+            return False
+
+        changed = False
+        position = 0
+        while position < len(self.buffer):
+            command = self.buffer[position]
+            size = self.sizes.get(command)
+            if size is None:
+                self.failed = True
+                break
+            if position + size + 1 > len(self.buffer):
+                break
+
+            event = self.buffer[position : position + size + 1]
+            position += size + 1
+            if command == GAME_START:
+                self.read_game_start(event)
+                changed = True
+            elif command == POST_FRAME_UPDATE:
+                changed |= self.read_post_frame(event)
+            elif command == GAME_END:
+                self.read_game_end(event)
+                changed = True
+                break
+
+        self.offset += position
+        self.buffer = self.buffer[position:]
+        if self.ended:
+            self.buffer = b""
+        return changed
+
+    def read_game_start(self, event: bytes) -> None:
+        self.stage = struct.unpack_from(">H", event, GAME_START_STAGE)[0]
+        for port in range(4):
+            player = GAME_START_PLAYERS + port * GAME_START_PLAYER_SIZE
+            if event[player + 1] == PLAYER_EMPTY:
+                continue
+
+            code = ""
+            # Connect codes were added in replay version 3.9.0.
+            offset = GAME_START_CODES + port * GAME_START_CODE_SIZE
+            if len(event) >= offset + GAME_START_CODE_SIZE:
+                code = (
+                    event[offset : offset + GAME_START_CODE_SIZE]
+                    .split(b"\0", 1)[0]
+                    .decode("shift_jis", errors="replace")
+                )
+            self.players.append(
+                {
+                    "type": event[player + 1],
+                    "code": code,
+                    "port": port,
+                    "character": event[player],
+                    "stocks": event[player + 2],
+                    "placement": None,
+                }
+            )
+        for player in self.players:
+            self.stocks[player["port"]] = player["stocks"]
+
+    def read_post_frame(self, event: bytes) -> bool:
+        frame, port, follower = struct.unpack_from(">iB?", event, 1)
+        self.frame = frame
+        if follower or len(event) <= POST_FRAME_STOCKS:
+            return False
+        characters = self.characters.setdefault(port, {})
+        character = event[POST_FRAME_CHARACTER]
+        characters[character] = characters.get(character, 0) + 1
+        stocks = event[POST_FRAME_STOCKS]
+        if self.stocks.get(port) == stocks:
+            return False
+        self.stocks[port] = stocks
+        return True
+
+    def read_game_end(self, event: bytes) -> None:
+        lras_initiator = None
+        if len(event) > GAME_END_LRAS:
+            lras_initiator = struct.unpack_from(">b", event, GAME_END_LRAS)[0]
+        placements = None
+        # Placements were added in replay version 3.13.0.
+        if len(event) >= GAME_END_PLACEMENTS + 4:
+            placements = struct.unpack_from(">4b", event, GAME_END_PLACEMENTS)
+        self.end = {
+            "method": event[GAME_END_METHOD],
+            "lras_initiator": (
+                lras_initiator
+                if lras_initiator is not None and lras_initiator >= 0
+                else None
+            ),
+            "placements": placements,
+        }
+
+    def facts(self) -> Optional[Dict]:
+        """Facts of the game as far as it has been written."""
+        if not self.started:
+            return None
+
+        humans = all(player["type"] == 0 for player in self.players)
+        players = []
+        for player in self.players:
+            stocks = self.stocks.get(player["port"])
+            placement = None
+            if self.ended and self.end["placements"] is not None:
+                placement = self.end["placements"][player["port"]]
+            character = player["character"]
+            # Same as read_replay_facts, use the one played for more frames.
+            if character in {id.CSSCharacter.ZELDA, id.CSSCharacter.SHEIK}:
+                played = self.characters.get(player["port"])
+                if played:
+                    character = id.CSSCharacter[
+                        id.InGameCharacter(max(played, key=played.get)).name
+                    ].value
+            players.append(
+                player
+                | {
+                    "character": character,
+                    # Matches read_replay_facts, which skips CPU game stocks.
+                    "stocks": stocks if humans else None,
+                    "placement": placement,
+                }
+            )
+
+        if self.ended and self.end["placements"] is None:
+            # Older replays don't say, the player with most stocks left won.
+            most = max(self.stocks.values())
+            for player in players:
+                player["placement"] = (
+                    0 if self.stocks.get(player["port"]) == most else 1
+                )
+
+        return {
+            "datetime": self.datetime,
+            "stage": self.stage,
+            "end_type": self.end["method"] if self.ended else None,
+            "lras_initiator": self.end["lras_initiator"] if self.ended else None,
+            "frames": self.frame,
+            "players": players,
+        }
@@ -0,0 +1,174 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from slippi import id
+
+from utils import elo
+
+CHARACTER_COUNT = elo.CHARACTER_COUNT
+# Columns elo.eligible_games has to pass through for game_stats.
+COLUMNS = (
+    "stage",
+    "p1_port",
+    "p2_port",
+    "p1_stocks",
+    "p2_stocks",
+    "frames",
+    "end_type",
+    "lras_initiator",
+)
+# Game length histogram bins in seconds, the last one is open ended.
+DURATION_BIN_SECONDS = 30
+DURATION_BINS = 17
+END_TYPES = {1: "time", 2: "game", 7: "no_contest"}
+
+
+def stage_name(stage: int) -> str:
+    try:
+        return id.Stage(stage).name
+    except ValueError:
+        return str(stage)
+
+
+def perspective(games: pd.DataFrame, player: str) -> Dict[str, np.ndarray]:
+    """Columns of `games` as seen by `player`, P1 or P2."""
+    own, other = ("p1", "p2") if player == "P1" else ("p2", "p1")
+    port = games[f"{own}_port"].to_numpy(dtype=float, na_value=np.nan)
+    lras = games["lras_initiator"].to_numpy(dtype=float, na_value=np.nan)
+    return {
+        "character": games[f"{own}_character"].to_numpy(),
+        "opponent": games[f"{other}_character"].to_numpy(),
+        "won": games[f"{own}_won"].to_numpy(dtype=bool),
+        "stocks": games[f"{own}_stocks"].to_numpy(dtype=float, na_value=np.nan),
+        "opponent_stocks": games[f"{other}_stocks"].to_numpy(
+            dtype=float, na_value=np.nan
+        ),
+        "quit": lras == port,
+        "stage": games["stage"].to_numpy(dtype=np.int64, na_value=-1),
+        "seconds": games["frames"].to_numpy(dtype=float, na_value=np.nan) / 60,
+        "end_type": games["end_type"].to_numpy(dtype=np.int64, na_value=-1),
+    }
+
+
+def filter_games(
+    games: pd.DataFrame,
+    player: str = "P1",
+    character: Optional[int] = None,
+    opponent: Optional[int] = None,
+    stage: Optional[int] = None,
+) -> pd.DataFrame:
+    own, other = ("p1", "p2") if player == "P1" else ("p2", "p1")
+    mask = np.ones(len(games), dtype=bool)
+    if character is not None:
+        mask &= games[f"{own}_character"].to_numpy() == character
+    if opponent is not None:
+        mask &= games[f"{other}_character"].to_numpy() == opponent
+    if stage is not None:
+        mask &= games["stage"].to_numpy(dtype=np.int64, na_value=-1) == stage
+    return games[mask]
+
+
+def _mean(total: float, count: float):
+    # Same convention as the matchup chart for cells without games.
+    return float(total / count) if count else "nan"
+
+
+def stage_win_rates(columns: Dict[str, np.ndarray]) -> List[Dict]:
+    # Stage ids are small, so they index the counts directly. Missing is -1.
+    stage = columns["stage"] + 1
+    span = int(stage.max()) + 1 if len(stage) else 1
+    key = columns["character"] * span + stage
+    games = np.bincount(key, minlength=CHARACTER_COUNT * span)
+    wins = np.bincount(key, weights=columns["won"], minlength=CHARACTER_COUNT * span)
+
+    return [
+        {
+            "character": id.CSSCharacter(int(cell // span)).name,
+            "stage": stage_name(int(cell % span) - 1),
+            "games": int(games[cell]),
+            "wins": int(wins[cell]),
+            "win_rate": float(wins[cell] / games[cell]),
+        }
+        for cell in np.flatnonzero(games)
+    ]
+
+
+def character_summaries(columns: Dict[str, np.ndarray]) -> List[Dict]:
+    character = columns["character"]
+
+    def total(values: np.ndarray) -> np.ndarray:
+        # Missing values count as zero, divide by count of the known ones.
+        return np.bincount(
+            character, weights=np.nan_to_num(values), minlength=CHARACTER_COUNT
+        )
+
+    margin = columns["stocks"] - columns["opponent_stocks"]
+    # CPU games and old replays may lack stocks.
+    known = ~np.isnan(margin)
+    won_known = known & columns["won"]
+    games = np.bincount(character, minlength=CHARACTER_COUNT)
+    wins = total(columns["won"])
+    margins = total(margin)
+    margin_games = total(known)
+    stocks_in_wins = total(np.where(won_known, columns["stocks"], 0))
+    win_games = total(won_known)
+    quits = total(columns["quit"])
+    seconds = total(columns["seconds"])
+    timed_games = total(~np.isnan(columns["seconds"]))
+
+    return [
+        {
+            "character": id.CSSCharacter(int(i)).name,
+            "games": int(games[i]),
+            "win_rate": _mean(wins[i], games[i]),
+            "stock_differential": _mean(margins[i], margin_games[i]),
+            "stocks_left_in_wins": _mean(stocks_in_wins[i], win_games[i]),
+            "quits": int(quits[i]),
+            "average_seconds": _mean(seconds[i], timed_games[i]),
+        }
+        for i in np.flatnonzero(games)
+    ]
+
+
+def durations(columns: Dict[str, np.ndarray]) -> Dict:
+    seconds = columns["seconds"][~np.isnan(columns["seconds"])]
+    bins = np.minimum(seconds // DURATION_BIN_SECONDS, DURATION_BINS - 1)
+    counts = np.bincount(bins.astype(np.int64), minlength=DURATION_BINS)
+    if not len(seconds):
+        median = p90 = mean = "nan"
+    else:
+        median, p90 = np.quantile(seconds, [0.5, 0.9]).tolist()
+        mean = float(seconds.mean())
+    return {
+        "bins": [i * DURATION_BIN_SECONDS for i in range(DURATION_BINS)],
+        "counts": counts.tolist(),
+        "mean": mean,
+        "median": median,
+        "p90": p90,
+    }
+
+
+def end_types(columns: Dict[str, np.ndarray]) -> Dict[str, int]:
+    types, counts = np.unique(columns["end_type"], return_counts=True)
+    return {
+        END_TYPES.get(int(end_type), str(end_type)): int(count)
+        for end_type, count in zip(types, counts)
+    }
+
+
+def game_stats(games: pd.DataFrame, player: str = "P1") -> Dict:
+    """Win rates by stage, stock margins and game lengths of `player`.
+
+    `games` as returned by elo.eligible_games with COLUMNS. Every breakdown
+    is a single grouped pass over the columns, so the cost doesn't depend
+    on how many characters or stages there are.
+    """
+    columns = perspective(games, player)
+    return {
+        "games": len(games),
+        "characters": character_summaries(columns),
+        "stages": stage_win_rates(columns),
+        "durations": durations(columns),
+        "end_types": end_types(columns),
+    }
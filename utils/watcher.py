@@ -0,0 +1,174 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import settings
+from utils.files import is_file_locked
+
+if sys.platform.startswith("linux"):
+    import fcntl
+    import termios
+
+IN_NONBLOCK = 0o4000
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class PollingWatcher:
+    """Reports files added to a directory once they are completely written.
+
+    A file counts as complete when its size hasn't changed for
+    `settle_seconds` and nobody holds it locked.
+    """
+
+    def __init__(
+        self, directory: str, settle_seconds: float = settings.FILE_SETTLE_SECONDS
+    ):
+        self.directory = directory
+        self.settle_seconds = settle_seconds
+        # Files already in the directory are handled by the caller.
+        self.known = set(os.listdir(directory))
+        self.pending: Dict[str, Tuple[int, float]] = {}
+        # When each file was first noticed, to measure how long it was waited on.
+        self.seen: Dict[str, float] = {}
+        # Files that appeared while watching and are still being written.
+        self.created: Set[str] = set()
+
+    def track(self, path: str) -> None:
+        self.known.add(os.path.basename(path))
+        self.seen.setdefault(path, time.monotonic())
+        self.pending.setdefault(path, (-1, time.monotonic()))
+
+    def waited(self, path: str) -> Optional[float]:
+        """Seconds between noticing a reported file and reporting it."""
+        seen = self.seen.pop(path, None)
+        return None if seen is None else time.monotonic() - seen
+
+    def scan(self) -> None:
+        for entry in os.scandir(self.directory):
+            if entry.name not in self.known and entry.is_file():
+                self.track(entry.path)
+                self.created.add(entry.path)
+
+    def settled(self) -> List[str]:
+        now = time.monotonic()
+        ready = []
+        for path, (size, changed) in list(self.pending.items()):
+            try:
+                new_size = os.stat(path).st_size
+            except FileNotFoundError:
+                del self.pending[path]
+                self.seen.pop(path, None)
+                self.created.discard(path)
+                continue
+
+            if new_size != size:
+                self.pending[path] = (new_size, now)
+            elif now - changed >= self.settle_seconds and not is_file_locked(path):
+                del self.pending[path]
+                self.created.discard(path)
+                ready.append(path)
+
+        return ready
+
+    def poll(self) -> List[str]:
+        self.scan()
+        return self.settled()
+
+    def writing(self) -> List[str]:
+        """Files being written that poll hasn't reported yet."""
+        self.scan()
+        return list(self.created)
+
+    def close(self) -> None:
+        self.pending.clear()
+        self.seen.clear()
+        self.created.clear()
+
+
+class InotifyWatcher(PollingWatcher):
+    """Linux watcher that reports files as soon as the writer closes them."""
+
+    def __init__(
+        self, directory: str, settle_seconds: float = settings.FILE_SETTLE_SECONDS
+    ):
+        super().__init__(directory, settle_seconds)
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if (
+            libc.inotify_add_watch(
+                self.fd,
+                os.fsencode(directory),
+                IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO,
+            )
+            < 0
+        ):
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+
+    def read_events(self) -> List[Tuple[int, str]]:
+        events = []
+        while True:
+            # Check for pending events first: a green os.read would wait for them.
+            available = struct.unpack(
+                "i", fcntl.ioctl(self.fd, termios.FIONREAD, b"\0\0\0\0")
+            )[0]
+            if not available:
+                return events
+            buffer = os.read(self.fd, available)
+
+            offset = 0
+            while offset < len(buffer):
+                _, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(buffer[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                events.append((mask, name))
+
+    def poll(self) -> List[str]:
+        ready = []
+        for mask, name in self.read_events():
+            path = os.path.join(self.directory, name)
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.known.add(name)
+                self.pending.pop(path, None)
+                self.created.discard(path)
+                if path not in ready:
+                    ready.append(path)
+            elif mask & IN_CREATE:
+                self.known.add(name)
+                self.seen.setdefault(path, time.monotonic())
+                self.created.add(path)
+
+        # Files handed over with track() have no close event to wait for.
+        return ready + [path for path in self.settled() if path not in ready]
+
+    def writing(self) -> List[str]:
+        # Created files are only known from the events read by poll.
+        return list(self.created)
+
+    def close(self) -> None:
+        super().close()
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def create_watcher(directory: str) -> PollingWatcher:
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError) as e:
+            print(f"inotify unavailable, polling {directory} instead: {e}")
+
+    return PollingWatcher(directory)